@@ -1,35 +1,747 @@
+import ast
+import asyncio
+import codecs
+import datetime
+import fnmatch
 import functools
+import gc
+import gzip
+import hashlib
+import importlib
+import inspect
+import logging
+import math
+import os
+import pickle
+import posixpath
+import py_compile
+import re
 import sys
-from collections.abc import Mapping
+import threading
+import time
+import types
+import weakref
+from collections import ChainMap, OrderedDict, deque, namedtuple
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from aiohttp import web
+from aiohttp import hdrs, web
 from mako.lookup import TemplateLookup
-from mako.exceptions import TemplateLookupException, text_error_template
+from mako.exceptions import (NameConflictError, TemplateLookupException,
+                             text_error_template)
+from mako.runtime import Context
+from mako.template import ModuleTemplate
+from mako.util import FastEncodingBuffer
+
+from .stats import (PROMETHEUS_CONTENT_TYPE, MemoryUsage, RenderStats,
+                    memory_usage, template_cache_prometheus)
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
 __version__ = '0.4.0'
 
 __all__ = ('setup', 'get_lookup', 'render_template', 'template',
-           'render_string')
+           'render_string', 'render_template_async', 'render_string_async',
+           'render_stream', 'warmup', 'RenderCache', 'provides',
+           'run_context_processors', 'TemplateProcessPool', 'RenderSignal',
+           'RenderEvent', 'RenderStats', 'render_stats_handler',
+           'invalidate_template', 'CompiledTemplateLookup',
+           'compile_templates', 'preload', 'memory_usage', 'MemoryUsage',
+           'render_fragment', 'TemplateGraph', 'get_template_graph',
+           'render_many', 'RenderResult', 'OffloadPolicy',
+           'cached_processor', 'CachedProcessor', 'TemplateCache')
 
 
 APP_KEY = 'aiohttp_mako_lookup'
 APP_CONTEXT_PROCESSORS_KEY = 'aiohttp_mako_context_processors'
+APP_CONTEXT_PROCESSORS_TIMEOUT_KEY = 'aiohttp_mako_context_processors_timeout'
+APP_EXECUTOR_KEY = 'aiohttp_mako_executor'
+APP_RENDER_CACHE_KEY = 'aiohttp_mako_render_cache'
+APP_ON_RENDER_START_KEY = 'aiohttp_mako_on_render_start'
+APP_ON_RENDER_DONE_KEY = 'aiohttp_mako_on_render_done'
+APP_RENDER_STATS_KEY = 'aiohttp_mako_render_stats'
+APP_BOUND_TEMPLATES_KEY = 'aiohttp_mako_bound_templates'
+APP_TEMPLATE_GRAPHS_KEY = 'aiohttp_mako_template_graphs'
+APP_OFFLOAD_POLICY_KEY = 'aiohttp_mako_offload_policy'
+APP_STREAM_EXECUTOR_KEY = 'aiohttp_mako_stream_executor'
+_APP_STARTUP_COMPILE_TIMES_KEY = 'aiohttp_mako_startup_compile_times'
 REQUEST_CONTEXT_KEY = 'aiohttp_mako_context'
+REQUEST_LAZY_PROCESSORS_KEY = 'aiohttp_mako_lazy_context_processors'
+
+STREAM_CHUNK_SIZE = 64 * 1024
+COMPRESS_MIN_SIZE = 1024
 
+logger = logging.getLogger('aiohttp_mako')
 
-def setup(app, *args, app_key=APP_KEY, context_processors=(), **kwargs):
-    app[app_key] = TemplateLookup(*args, **kwargs)
+
+def setup(app, *args, app_key=APP_KEY, context_processors=(),
+          context_processors_timeout=None, executor=None, precompile=False,
+          render_cache=None, processes=None, observers=(), stats=False,
+          reload_interval=None, compiled=None, offload_budget=None,
+          template_cache=None, stream_threads=None, **kwargs):
+    if compiled is not None and not isinstance(compiled, str):
+        compiled = compiled.__name__
+    lookup = app[app_key] = _make_lookup(args, kwargs, compiled)
+    if template_cache is not None:
+        lookup._collection = template_cache
+    on_render_start = app.setdefault(APP_ON_RENDER_START_KEY, RenderSignal())
+    on_render_done = app.setdefault(APP_ON_RENDER_DONE_KEY, RenderSignal())
+    if stats:
+        app[APP_RENDER_STATS_KEY] = RenderStats()
+        observers = tuple(observers) + (app[APP_RENDER_STATS_KEY],)
+    for observer in observers:
+        on_render_start.append(observer.on_render_start)
+        on_render_done.append(observer.on_render_done)
     if context_processors:
         app[APP_CONTEXT_PROCESSORS_KEY] = context_processors
+        app[APP_CONTEXT_PROCESSORS_TIMEOUT_KEY] = context_processors_timeout
         app.middlewares.append(context_processors_middleware)
-    return app[app_key]
+    if processes:
+        executor = TemplateProcessPool(
+            args, kwargs, compiled=compiled,
+            max_workers=None if processes is True else processes)
+
+        async def shutdown_process_pool(app):
+            executor.shutdown()
+
+        app.on_cleanup.append(shutdown_process_pool)
+    if executor is not None:
+        app[APP_EXECUTOR_KEY] = executor
+    if stream_threads is not None:
+        stream_executor = app[APP_STREAM_EXECUTOR_KEY] = ThreadPoolExecutor(
+            max_workers=stream_threads)
+
+        async def shutdown_stream_executor(app):
+            stream_executor.shutdown(wait=False)
+
+        app.on_cleanup.append(shutdown_stream_executor)
+    if offload_budget is not None:
+        app[APP_OFFLOAD_POLICY_KEY] = OffloadPolicy(offload_budget)
+    if render_cache is not None:
+        app[APP_RENDER_CACHE_KEY] = render_cache
+    app.setdefault(APP_BOUND_TEMPLATES_KEY, {})
+    app.setdefault(_APP_STARTUP_COMPILE_TIMES_KEY, {})
+    graphs = app.setdefault(APP_TEMPLATE_GRAPHS_KEY, {})
+    graphs[app_key] = TemplateGraph(lookup)
+
+    async def bind_templates(app):
+        _bind_templates(app, app_key)
+
+    app.on_startup.append(bind_templates)
+    if reload_interval is not None:
+        lookup.filesystem_checks = False
+        watchers = []
+
+        async def start_watcher(app):
+            watchers.append(asyncio.ensure_future(
+                _watch_templates(app, app_key, reload_interval)))
+
+        async def stop_watcher(app):
+            for watcher in watchers:
+                watcher.cancel()
+            await asyncio.gather(*watchers, return_exceptions=True)
+
+        app.on_startup.append(start_watcher)
+        app.on_cleanup.append(stop_watcher)
+    if precompile:
+        patterns = ('*',) if precompile is True else precompile
+
+        async def precompile_templates(app):
+            warmup(lookup, patterns)
+
+        app.on_startup.append(precompile_templates)
+    return lookup
+
+
+def _iter_template_uris(lookup, patterns):
+    if isinstance(lookup, CompiledTemplateLookup):
+        for uri in sorted(lookup.modules):
+            if any(fnmatch.fnmatch(uri, pattern) for pattern in patterns):
+                yield uri
+    for directory in lookup.directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                uri = os.path.relpath(path, directory).replace(os.sep, '/')
+                if any(fnmatch.fnmatch(uri, pattern) for pattern in patterns):
+                    yield uri
+
+
+def warmup(lookup, patterns=('*',)):
+    """Compile all templates from *lookup* directories matching *patterns*.
+
+    Returns number of compiled templates, raises
+    :exc:`MakoCompilationException` listing every template failed to compile.
+    """
+    started = time.monotonic()
+    compiled = 0
+    failed = []
+    for uri in _iter_template_uris(lookup, patterns):
+        try:
+            lookup.get_template(uri)
+        except Exception:
+            logger.error('Failed to compile template %r:\n%s', uri,
+                         text_error_template().render())
+            failed.append(uri)
+        else:
+            compiled += 1
+    logger.info('Compiled %d templates in %.3f seconds',
+                compiled, time.monotonic() - started)
+    if failed:
+        raise MakoCompilationException(
+            'Failed to compile templates: {}'.format(', '.join(failed)))
+    return compiled
+
+
+def preload(lookup, patterns=('*',)):
+    """Compile templates in master process before forking workers.
+
+    Like :func:`warmup`, but also analyses compiled templates and moves
+    all objects into permanent generation with :func:`gc.freeze`, so
+    garbage collections in workers don't write to memory pages shared
+    copy-on-write with the master process.
+    """
+    compiled = warmup(lookup, patterns)
+    for template in list(lookup._collection.values()):
+        _scan_template(template)
+        _page_args(template)
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return compiled
+
+
+class CompiledTemplateLookup(TemplateLookup):
+    """Template lookup loading templates from package of compiled modules.
+
+    The package is built by :func:`compile_templates`, its templates are
+    imported on first use without running Mako lexer and compiler.
+    Templates missing in the package are looked up in *directories* as
+    usual.
+    """
+
+    def __init__(self, package, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.package = importlib.import_module(package)
+        self.modules = self.package.TEMPLATES
+        self._module_template_args = {
+            name: value for name, value in self.template_args.items()
+            if name in _MODULE_TEMPLATE_ARGS}
+
+    def get_template(self, uri):
+        template = self._collection.get(uri)
+        if template is not None:
+            return template
+        name = posixpath.normpath(uri.replace('\\', '/').lstrip('/'))
+        module_name = self.modules.get(name)
+        if module_name is None:
+            return super().get_template(uri)
+        with self._mutex:
+            template = self._collection.get(uri)
+            if template is None:
+                module = importlib.import_module(
+                    '{}.{}'.format(self.package.__name__, module_name))
+                template = self._collection[uri] = ModuleTemplate(
+                    module, module_filename=getattr(module, '__file__', None),
+                    template_source=module._template_source, lookup=self,
+                    **self._module_template_args)
+            return template
+
+
+_MODULE_TEMPLATE_ARGS = frozenset(
+    inspect.signature(ModuleTemplate).parameters) - {'module', 'lookup'}
+
+
+def _module_name(uri, used):
+    name = base = '_' + re.sub(r'\W', '_', uri)
+    index = 1
+    while name in used:
+        index += 1
+        name = '{}_{}'.format(base, index)
+    used.add(name)
+    return name
+
+
+def compile_templates(lookup, output, package, patterns=('*',), pyc=False):
+    """Compile templates of *lookup* into importable package.
+
+    Templates from *lookup* directories matching *patterns* are written as
+    modules of package *package* in *output* directory, along with
+    ``.pyc`` files if *pyc* is true.  Template sources are kept in the
+    modules for error reports.  Returns number of compiled templates,
+    raises :exc:`MakoCompilationException` listing every template failed to
+    compile.
+    """
+    directory = os.path.join(output, *package.split('.'))
+    os.makedirs(directory, exist_ok=True)
+    modules = {}
+    failed = []
+    for uri in _iter_template_uris(lookup, patterns):
+        try:
+            template = lookup.get_template(uri)
+            code = template.code
+            source = template.source
+        except Exception:
+            logger.error('Failed to compile template %r:\n%s', uri,
+                         text_error_template().render())
+            failed.append(uri)
+            continue
+        name = modules[uri] = _module_name(uri, set(modules.values()))
+        path = os.path.join(directory, name + '.py')
+        with open(path, 'w', encoding='utf-8') as fp:
+            if not code.startswith('# -*- coding'):
+                fp.write('# -*- coding:utf-8 -*-\n')
+            fp.write(code)
+            fp.write('\n_template_source = {!r}\n'.format(source))
+        if pyc:
+            py_compile.compile(path, doraise=True)
+    if failed:
+        raise MakoCompilationException(
+            'Failed to compile templates: {}'.format(', '.join(failed)))
+    path = os.path.join(directory, '__init__.py')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write('"""Templates compiled by aiohttp_mako {}."""\n\n'
+                 'TEMPLATES = {{\n'.format(__version__))
+        for uri, name in sorted(modules.items()):
+            fp.write('    {!r}: {!r},\n'.format(uri, name))
+        fp.write('}\n')
+    if pyc:
+        py_compile.compile(path, doraise=True)
+    logger.info('Compiled %d templates into %s', len(modules), directory)
+    return len(modules)
+
+
+def _make_lookup(args, kwargs, compiled=None):
+    if compiled is None:
+        return TemplateLookup(*args, **kwargs)
+    return CompiledTemplateLookup(compiled, *args, **kwargs)
+
+
+def _code_size(code):
+    size = sys.getsizeof(code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            size += _code_size(const)
+        else:
+            size += sys.getsizeof(const)
+    return size
+
+
+def _template_size(template):
+    """Return approximate size of compiled *template* in bytes.
+
+    Counts code objects and strings of the template module and sources
+    Mako keeps for error reports, shared objects are counted too.
+    """
+    namespace = template.module.__dict__
+    size = sys.getsizeof(namespace)
+    for value in namespace.values():
+        code = getattr(value, '__code__', None)
+        if code is not None:
+            size += sys.getsizeof(value) + _code_size(code)
+        elif isinstance(value, (str, bytes)):
+            size += sys.getsizeof(value)
+    info = getattr(template, '_mmarker', None)
+    for source in (getattr(info, 'module_source', None),
+                   getattr(info, 'template_source', None)):
+        if source is not None:
+            size += sys.getsizeof(source)
+    return size
+
+
+class TemplateCache(MutableMapping):
+    """Compiled templates of a lookup bounded by their approximate size.
+
+    Least recently used templates are dropped when estimated size of all
+    templates exceeds *maxbytes*.  Templates matching *pinned* glob
+    patterns are never dropped.  Pass it to :func:`aiohttp_mako.setup`
+    with ``template_cache`` argument.
+    """
+
+    def __init__(self, maxbytes, pinned=()):
+        self.maxbytes = maxbytes
+        self.pinned = set(pinned)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_time = 0.0
+        self.recompiles = 0
+        self.recompile_time = 0.0
+        self._templates = OrderedDict()
+        self._sizes = {}
+        self._missed = {}
+        self._evicted = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __iter__(self):
+        return iter(list(self._templates))
+
+    def __contains__(self, uri):
+        return uri in self._templates
+
+    def __getitem__(self, uri):
+        with self._lock:
+            try:
+                template = self._templates[uri]
+            except KeyError:
+                # Mako compiles the template after a failed lookup
+                if len(self._missed) >= 1024:
+                    self._missed.clear()
+                self._missed.setdefault(uri, time.perf_counter())
+                raise
+            self._templates.move_to_end(uri)
+            self.hits += 1
+            return template
+
+    def __setitem__(self, uri, template):
+        size = _template_size(template)
+        with self._lock:
+            started = self._missed.pop(uri, None)
+            if started is not None:
+                elapsed = time.perf_counter() - started
+                self.misses += 1
+                self.compile_time += elapsed
+                if uri in self._evicted:
+                    self.recompiles += 1
+                    self.recompile_time += elapsed
+            self._evicted.discard(uri)
+            self._discard(uri)
+            self._templates[uri] = template
+            self._sizes[uri] = size
+            self.bytes += size
+            self._evict()
+
+    def __delitem__(self, uri):
+        with self._lock:
+            if uri not in self._templates:
+                raise KeyError(uri)
+            self._discard(uri)
+            self._evicted.discard(uri)
+
+    def pop(self, uri, *default):
+        with self._lock:
+            if uri not in self._templates:
+                self._evicted.discard(uri)
+                if default:
+                    return default[0]
+                raise KeyError(uri)
+            template = self._templates[uri]
+            del self[uri]
+            return template
+
+    def keys(self):
+        return self._templates.keys()
+
+    def values(self):
+        return self._templates.values()
+
+    def items(self):
+        return self._templates.items()
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._sizes.clear()
+            self._evicted.clear()
+            self.bytes = 0
+
+    def pin(self, pattern):
+        """Never drop templates matching glob *pattern*."""
+        self.pinned.add(pattern)
+
+    def unpin(self, pattern):
+        self.pinned.discard(pattern)
+
+    def is_pinned(self, uri):
+        name = _template_key(uri)
+        return any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in self.pinned)
+
+    def size(self, uri):
+        """Return estimated size of compiled template *uri* in bytes."""
+        return self._sizes[uri]
+
+    def _discard(self, uri):
+        if uri in self._templates:
+            del self._templates[uri]
+            self.bytes -= self._sizes.pop(uri)
+
+    def _evict(self):
+        if self.bytes <= self.maxbytes:
+            return
+        newest = next(reversed(self._templates))
+        for uri in list(self._templates):
+            if self.bytes <= self.maxbytes:
+                break
+            if uri == newest or self.is_pinned(uri):
+                continue
+            self._discard(uri)
+            self._evicted.add(uri)
+            self.evictions += 1
+
+    def stats(self):
+        """Return dictionary of cache statistics."""
+        with self._lock:
+            return {'entries': len(self._templates), 'bytes': self.bytes,
+                    'maxbytes': self.maxbytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'compile_time': self.compile_time,
+                    'recompiles': self.recompiles,
+                    'recompile_time': self.recompile_time}
 
 
 def get_lookup(app, *, app_key=APP_KEY):
     return app.get(app_key)
 
 
-def render_string(template_name, request, context, *, app_key):
+def _bind_templates(app, app_key):
+    """Resolve templates of :func:`template` decorated handlers.
+
+    Fails on missing templates, compiled templates are stored in the
+    application unless lookup checks files for changes on every render or
+    keeps them in :class:`TemplateCache`.  Compile times are reported by
+    first renders of the templates.
+    """
+    lookup = app[app_key]
+    bound = app[APP_BOUND_TEMPLATES_KEY]
+    compile_times = app[_APP_STARTUP_COMPILE_TIMES_KEY]
+    for route in app.router.routes():
+        template_name, handler_app_key, fragment = getattr(
+            route.handler, '_aiohttp_mako_template', (None, None, None))
+        if template_name is None or handler_app_key != app_key:
+            continue
+        compiled = template_name in lookup._collection
+        started = time.perf_counter()
+        try:
+            template = lookup.get_template(template_name)
+        except TemplateLookupException as e:
+            raise TemplateLookupException(
+                "Template '{}' of handler {!r} not found".format(
+                    template_name, route.handler)) from e
+        if not compiled:
+            compile_times[app_key, template_name] = (
+                time.perf_counter() - started)
+        if fragment is not None:
+            try:
+                _get_fragment(template, fragment)
+            except web.HTTPInternalServerError as e:
+                raise TemplateLookupException(
+                    "Fragment '{}' of handler {!r} not found".format(
+                        fragment, route.handler)) from e
+        if not (lookup.filesystem_checks or
+                isinstance(lookup._collection, TemplateCache)):
+            bound[app_key, template_name] = template
+
+
+def get_template_graph(app, *, app_key=APP_KEY):
+    return app.get(APP_TEMPLATE_GRAPHS_KEY, {}).get(app_key)
+
+
+def _template_key(uri):
+    return posixpath.normpath('/' + uri.replace('\\', '/')).lstrip('/')
+
+
+class TemplateGraph:
+    """Index of templates inheriting, including and importing others.
+
+    Built from compiled templates of *lookup*, templates compiled later are
+    indexed on next query.  Template names are normalized to paths without
+    leading slash.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self._indexed = {}
+        self._dependencies = {}
+        self._dependents = {}
+        self._dynamic = set()
+
+    def _update(self):
+        for uri, template in list(self.lookup._collection.items()):
+            indexed = self._indexed.get(uri)
+            if indexed is not None and indexed() is template:
+                continue
+            self._indexed[uri] = weakref.ref(template)
+            name = _template_key(uri)
+            for kind, dependency in self._dependencies.pop(name, ()):
+                self._dependents.get(dependency, set()).discard(name)
+            self._dynamic.discard(name)
+            dependencies = self._dependencies[name] = set()
+            for kind, dependency in _scan_template(template)[1]:
+                if dependency is None:
+                    self._dynamic.add(name)
+                else:
+                    dependency = _template_key(self.lookup.adjust_uri(
+                        dependency, template.uri))
+                    self._dependents.setdefault(dependency, set()).add(name)
+                dependencies.add((kind, dependency))
+
+    def dependencies(self, template_name):
+        """Return ``(kind, name)`` pairs of templates *template_name* uses.
+
+        Kind is ``'inherit'``, ``'include'`` or ``'namespace'``, name is
+        ``None`` if the template is chosen on render.
+        """
+        self._update()
+        return set(self._dependencies.get(_template_key(template_name), ()))
+
+    def dependents(self, template_name):
+        """Return names of templates using *template_name*.
+
+        Templates using it through other templates and templates choosing
+        used templates on render are included.
+        """
+        self._update()
+        name = _template_key(template_name)
+        found = {name} | self._dynamic
+        stack = list(found)
+        while stack:
+            for dependent in self._dependents.get(stack.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        found.discard(name)
+        return found
+
+    def edges(self):
+        """Return sorted ``(name, kind, dependency)`` triples."""
+        self._update()
+        return sorted(
+            ((name, kind, dependency)
+             for name, dependencies in self._dependencies.items()
+             for kind, dependency in dependencies),
+            key=lambda edge: (edge[0], edge[1], edge[2] or ''))
+
+
+def invalidate_template(app, template_name, *, app_key=APP_KEY):
+    """Drop compiled template and cached renders of it and its dependents.
+
+    The template is compiled again on next render.  Compiled dependents
+    are kept, Mako looks up inherited and included templates on render.
+    """
+    lookup = app[app_key]
+    bound = app[APP_BOUND_TEMPLATES_KEY]
+    graph = get_template_graph(app, app_key=app_key)
+    dependents = set() if graph is None else graph.dependents(template_name)
+    lookup._collection.pop(template_name, None)
+    bound.pop((app_key, template_name), None)
+    render_cache = app.get(APP_RENDER_CACHE_KEY)
+    names = {template_name} | dependents
+    if dependents:
+        templates = list(lookup._collection.items()) + [
+            (uri, template) for (key, uri), template in bound.items()
+            if key == app_key]
+        for uri, template in templates:
+            if _template_key(uri) in dependents:
+                names.add(uri)
+    if render_cache is not None:
+        for name in names:
+            render_cache.invalidate(name)
+
+
+def _changed_templates(lookup):
+    changed = []
+    for uri, template in list(lookup._collection.items()):
+        if template.filename is None:
+            continue
+        try:
+            modified_time = os.stat(template.filename).st_mtime
+        except OSError:
+            changed.append(uri)
+            continue
+        if template.module._modified_time < modified_time:
+            changed.append(uri)
+    return changed
+
+
+async def _watch_templates(app, app_key, interval):
+    """Poll modification times of compiled templates in background."""
+    loop = asyncio.get_event_loop()
+    lookup = app[app_key]
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await loop.run_in_executor(None, _changed_templates,
+                                                 lookup)
+        except Exception:
+            logger.exception('Failed to check templates for changes')
+            continue
+        for uri in changed:
+            logger.info('Template %r changed, reloading', uri)
+            invalidate_template(app, uri, app_key=app_key)
+
+
+class RenderSignal(list):
+    """List of callbacks called on rendering.
+
+    Unlike :class:`aiohttp.Signal` callbacks are regular functions, they
+    are called right from rendering code.
+    """
+
+    def send(self, *args):
+        for receiver in self:
+            receiver(*args)
+
+
+class RenderEvent:
+    """Timings of single template render passed to render signals.
+
+    Times are in seconds, *compile_time* is ``None`` if the template was
+    already compiled, *size* is length of rendered output in bytes or in
+    characters for text renders.
+    """
+
+    __slots__ = ('template_name', 'lookup_time', 'compile_time',
+                 'render_time', 'size', 'exception')
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self.lookup_time = None
+        self.compile_time = None
+        self.render_time = None
+        self.size = None
+        self.exception = None
+
+
+def _start_render(request, template_name):
+    on_render_start = request.app.get(APP_ON_RENDER_START_KEY)
+    on_render_done = request.app.get(APP_ON_RENDER_DONE_KEY)
+    if not on_render_start and not on_render_done:
+        return None
+    event = RenderEvent(template_name)
+    on_render_start.send(request, event)
+    return event
+
+
+def _finish_render(request, event):
+    request.app[APP_ON_RENDER_DONE_KEY].send(request, event)
+
+
+def _startup_compile_time(app, app_key, template_name):
+    compile_times = app.get(_APP_STARTUP_COMPILE_TIMES_KEY)
+    if compile_times:
+        return compile_times.pop((app_key, template_name), None)
+    return None
+
+
+def _get_template(template_name, request, app_key, event=None):
+    bound = request.app.get(APP_BOUND_TEMPLATES_KEY)
+    if bound:
+        template = bound.get((app_key, template_name))
+        if template is not None:
+            if event is not None:
+                event.lookup_time = 0.0
+                event.compile_time = _startup_compile_time(
+                    request.app, app_key, template_name)
+            return template
     lookup = request.app.get(app_key)
 
     if lookup is None:
@@ -38,49 +750,1246 @@ def render_string(template_name, request, context, *, app_key):
                   "call aiohttp_mako.setup(app_key={}) first"
                   "".format(app_key)))
     try:
+        if event is None:
+            return lookup.get_template(template_name)
+        compiled = template_name in lookup._collection
+        started = time.perf_counter()
         template = lookup.get_template(template_name)
+        event.lookup_time = time.perf_counter() - started
+        if not compiled:
+            event.compile_time = event.lookup_time
+        else:
+            event.compile_time = _startup_compile_time(
+                request.app, app_key, template_name)
+        return template
     except TemplateLookupException as e:
         raise web.HTTPInternalServerError(
             text="Template '{}' not found".format(template_name)) from e
+
+
+_DEPENDENCY_KINDS = {'_inherit_from': 'inherit', '_include_file': 'include',
+                     'TemplateNamespace': 'namespace'}
+_DYNAMIC_CONTEXT_RE = re.compile(r'\bcontext\s*[.\[]|\bpageargs\b')
+# functions of generated code receiving context, user code passing it
+# elsewhere may take any name from it
+_CONTEXT_CALLS = frozenset(('_mako_get_namespace',
+                            '_mako_generate_namespaces'))
+_DYNAMIC = object()
+
+
+def _literal(node):
+    if type(node).__name__ == 'Index':  # Python < 3.9
+        node = node.value
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return _DYNAMIC
+
+
+def _is_context(node):
+    return isinstance(node, ast.Name) and node.id == 'context'
+
+
+def _passes_context(node):
+    """Whether generated code of Mako passes context in call *node*."""
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id in _CONTEXT_CALLS or func.id.startswith('render_')
+    return isinstance(func, ast.Attribute) and \
+        isinstance(func.value, ast.Name) and func.value.id == 'runtime'
+
+
+_scan_cache = weakref.WeakKeyDictionary()
+
+
+def _scan_template(template):
+    """Return names template takes from context and templates it uses.
+
+    Names are ``None`` if template refers to the context itself
+    dynamically.  Dependencies are pairs of kind, one of ``'inherit'``,
+    ``'include'`` and ``'namespace'``, and uri, the uri is ``None`` if it
+    is computed on render.
+    """
+    try:
+        return _scan_cache[template]
+    except KeyError:
+        pass
+    identifiers = set()
+    if template.source is not None and _DYNAMIC_CONTEXT_RE.search(
+            template.source):
+        identifiers = None
+    dependencies = []
+    nodes = list(ast.walk(ast.parse(template.code)))
+    used = set()
+    for node in nodes:
+        if isinstance(node, (ast.Attribute, ast.Subscript)) and \
+                _is_context(node.value):
+            used.add(node.value)
+        elif isinstance(node, ast.Call) and _passes_context(node):
+            used.update(arg for arg in node.args if _is_context(arg))
+    for node in nodes:
+        name = None
+        if _is_context(node) and isinstance(node.ctx, ast.Load) and \
+                node not in used:
+            name = _DYNAMIC
+        elif isinstance(node, ast.Subscript) and _is_context(node.value):
+            name = _literal(node.slice)
+        elif (isinstance(node, ast.Call) and
+              isinstance(node.func, ast.Attribute)):
+            attr = node.func.attr
+            if attr == 'get' and _is_context(node.func.value) and node.args:
+                name = _literal(node.args[0])
+            elif attr == 'ModuleNamespace':
+                # functions of the module get the context
+                name = _DYNAMIC
+            elif attr in _DEPENDENCY_KINDS:
+                if attr == 'TemplateNamespace':
+                    uris = [keyword.value for keyword in node.keywords
+                            if keyword.arg == 'templateuri']
+                else:
+                    uris = node.args[1:2]
+                for uri in map(_literal, uris):
+                    if uri is _DYNAMIC:
+                        uri = None
+                    elif uri is None:
+                        continue
+                    dependencies.append((_DEPENDENCY_KINDS[attr], uri))
+        if name is _DYNAMIC:
+            identifiers = None
+        elif name is not None and identifiers is not None:
+            identifiers.add(name)
+    if identifiers is not None:
+        # arguments declared with <%page args="..."/> are taken from data
+        parameters = inspect.signature(template.callable_).parameters
+        identifiers.update(
+            param.name for param in parameters.values()
+            if param.name != 'context' and param.kind in (
+                param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY))
+    result = _scan_cache[template] = identifiers, dependencies
+    return result
+
+
+def _template_identifiers(template, _seen=None):
+    """Names *template* and templates it uses take from context.
+
+    Returns ``None`` if names can't be determined statically.  Only scans
+    of single templates are cached, used templates are looked up every
+    time, so templates recompiled by the lookup are taken into account.
+    """
+    if _seen is None:
+        _seen = set()
+    _seen.add(template.uri)
+    result, dependencies = _scan_template(template)
+    for kind, uri in dependencies:
+        if result is None or uri is None:
+            result = None
+            break
+        uri = template.lookup.adjust_uri(uri, template.uri)
+        if uri in _seen:
+            continue
+        try:
+            dependency = template.lookup.get_template(uri)
+        except TemplateLookupException:
+            result = None
+            break
+        dependency_identifiers = _template_identifiers(dependency, _seen)
+        if dependency_identifiers is None:
+            result = None
+            break
+        result = result | dependency_identifiers
+    return result
+
+
+def _required_processors(template, processors):
+    identifiers = _template_identifiers(template)
+    if identifiers is None:
+        return processors
+    return [processor for processor in processors
+            if not processor.provides.isdisjoint(identifiers)]
+
+
+async def _run_lazy_processors(request, template):
+    processors = request.get(REQUEST_LAZY_PROCESSORS_KEY)
+    if not processors:
+        return
+    required = _required_processors(template, processors)
+    if required:
+        request[REQUEST_LAZY_PROCESSORS_KEY] = [
+            processor for processor in processors
+            if processor not in required]
+        request[REQUEST_CONTEXT_KEY].update(
+            await _gather_processors(request, required))
+
+
+def _check_lazy_processors(request, template):
+    processors = request.get(REQUEST_LAZY_PROCESSORS_KEY)
+    if processors and _required_processors(template, processors):
+        raise web.HTTPInternalServerError(
+            text=("Context processors for template '{}' are not run, "
+                  "call aiohttp_mako.run_context_processors() first"
+                  "".format(template.uri)))
+
+
+async def run_context_processors(request, template_name, *, app_key=APP_KEY):
+    """Run context processors declared with :func:`provides` for template.
+
+    Only processors providing names the template uses are run, results are
+    added to the request context.
+    """
+    if request.get(REQUEST_LAZY_PROCESSORS_KEY):
+        template = _get_template(template_name, request, app_key)
+        await _run_lazy_processors(request, template)
+
+
+async def _resolve_awaitables(context):
+    """Await awaitable values of *context* concurrently.
+
+    Coroutine functions are called without arguments first.  Returns
+    dictionary of resolved values.
+    """
+    names = []
+    futures = []
+    for name, value in context.items():
+        if inspect.iscoroutinefunction(value):
+            value = value()
+        if inspect.isawaitable(value):
+            names.append(name)
+            futures.append(asyncio.ensure_future(value))
+    if not futures:
+        return {}
+    try:
+        results = await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return dict(zip(names, results))
+
+
+async def _resolve_context(context):
+    if not isinstance(context, Mapping):
+        return context
+    resolved = await _resolve_awaitables(context)
+    if resolved:
+        context = ChainMap(resolved, context)
+    return context
+
+
+def _get_context(request, context):
     if not isinstance(context, Mapping):
         raise web.HTTPInternalServerError(
             text="context should be mapping, not {}".format(type(context)))
     if request.get(REQUEST_CONTEXT_KEY):
-        context = dict(request[REQUEST_CONTEXT_KEY], **context)
+        context = ChainMap(context, request[REQUEST_CONTEXT_KEY])
+    return context
+
+
+def _rendering_exception():
+    exc_info = sys.exc_info()
+    errtext = text_error_template().render(
+        error=exc_info[1],
+        traceback=exc_info[2])
+    return MakoRenderingException(errtext).with_traceback(exc_info[2])
+
+
+_page_args_cache = weakref.WeakKeyDictionary()
+
+
+def _page_args(template):
+    """Names of keyword arguments of template callable.
+
+    ``None`` if it takes any keyword arguments, like bodies of templates
+    accepting ``**pageargs``.
+    """
+    try:
+        return _page_args_cache[template]
+    except KeyError:
+        pass
+    parameters = inspect.signature(template.callable_).parameters.values()
+    if any(param.kind == param.VAR_KEYWORD for param in parameters):
+        names = None
+    else:
+        names = tuple(
+            param.name for param in parameters
+            if param.name != 'context' and param.kind in (
+                param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY))
+    _page_args_cache[template] = names
+    return names
+
+
+def _make_mako_context(template, buffer, data):
+    """Create Mako context layered on top of *data*.
+
+    Returns the context and keyword arguments for the template callable,
+    the whole *data* as Mako passes it unless the callable is a def with
+    fixed arguments. Layers of :class:`ChainMap` are merged into one dict
+    once, instead of every unpacking iterating the chain.
+    """
+    if isinstance(data, ChainMap):
+        merged = {}
+        for mapping in reversed(data.maps):
+            merged.update(mapping)
+        data = merged
+    illegal_names = [name for name in template.reserved_names
+                     if name in data]
+    if illegal_names:
+        raise NameConflictError(
+            "Reserved words passed to render(): %s"
+            % ", ".join(illegal_names))
+    context = Context(buffer)
+    context._data = ChainMap(context._data, data)
+    context._kwargs = data
+    context._with_template = template
+    context._outputting_as_unicode = True
+    names = _page_args(template)
+    if names is None:
+        return context, data
+    return context, {name: data[name] for name in names if name in data}
+
+
+class _EncodingBuffer:
+    """Mako output buffer encoding written text by chunks.
+
+    Output is accumulated in :class:`bytearray` so the whole document is
+    never held both as text and as bytes.
+    """
+
+    chunk_size = 16 * 1024
+
+    def __init__(self, encoding):
+        self._encoder = codecs.getincrementalencoder(encoding)()
+        self._data = []
+        self._size = 0
+        self._body = bytearray()
+
+    def write(self, text):
+        self._data.append(text)
+        self._size += len(text)
+        if self._size >= self.chunk_size:
+            self._flush()
+
+    def _flush(self, final=False):
+        self._body += self._encoder.encode(''.join(self._data), final)
+        self._data = []
+        self._size = 0
+
+    def getvalue(self):
+        self._flush(final=True)
+        return self._body
+
+
+def _render(template, context, event=None, encoding=None):
+    started = time.perf_counter()
     try:
-        text = template.render_unicode(**context)
+        if encoding is None:
+            buffer = FastEncodingBuffer()
+        else:
+            buffer = _EncodingBuffer(encoding)
+        mako_context, kwargs = _make_mako_context(template, buffer, context)
+        template.render_context(mako_context, **kwargs)
+        return buffer.getvalue()
     except Exception:  # pragma: no cover
-        exc_info = sys.exc_info()
-        errtext = text_error_template().render(
-            error=exc_info[1],
-            traceback=exc_info[2])
-        exc = MakoRenderingException(errtext).with_traceback(exc_info[2])
-        raise exc
+        raise _rendering_exception()
+    finally:
+        if event is not None:
+            event.render_time = time.perf_counter() - started
+
+
+_content_types = {}
+
+
+def _make_response(body, encoding, status=200):
+    content_type = _content_types.get(encoding)
+    if content_type is None:
+        content_type = _content_types[encoding] = (
+            'text/html; charset={}'.format(encoding))
+    return web.Response(body=body, status=status,
+                        headers={hdrs.CONTENT_TYPE: content_type})
 
+
+class _CacheEntry:
+
+    __slots__ = ('value', 'expires', 'variants')
+
+    def __init__(self, value, expires):
+        self.value = value
+        self.expires = expires
+        self.variants = {}
+
+
+class RenderCache:
+    """LRU cache of rendered templates.
+
+    Entries are keyed by template name and cache key, *maxsize* bounds
+    number of entries, *ttl* is entries lifetime in seconds.  Expired
+    entries are served for *stale_ttl* more seconds while they are
+    rendered again in background.  Concurrent asynchronous renders of
+    the same entry wait for a single render.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, stale_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, template_name, key):
+        """Return cached entry and whether it is expired."""
+        entry = self._entries.get((template_name, key))
+        if entry is None:
+            return None, False
+        now = time.monotonic()
+        if entry.expires is None or entry.expires > now:
+            self._entries.move_to_end((template_name, key))
+            return entry, False
+        if self.stale_ttl is not None and \
+                entry.expires + self.stale_ttl > now:
+            return entry, True
+        del self._entries[template_name, key]
+        return None, False
+
+    def get(self, template_name, key):
+        entry, stale = self._lookup(template_name, key)
+        if entry is None or stale:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.value
+
+    def _get(self, template_name, key, render):
+        """Return cached output, refresh stale one in background."""
+        entry, stale = self._lookup(template_name, key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if stale:
+            self.stale_hits += 1
+            if (template_name, key) not in self._pending:
+                self._render(template_name, key, render, background=True)
+        else:
+            self.hits += 1
+        return entry.value
+
+    async def _get_or_render(self, template_name, key, render):
+        """Return cached output or the output of a single *render* call.
+
+        *render* is a coroutine function, concurrent callers wait for the
+        render already in flight.
+        """
+        value = self._get(template_name, key, render)
+        if value is not None:
+            return value
+        future = self._pending.get((template_name, key))
+        if future is None:
+            future = self._render(template_name, key, render)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def _render(self, template_name, key, render, background=False):
+        future = asyncio.ensure_future(render())
+        self._pending[template_name, key] = future
+        future.add_done_callback(functools.partial(
+            self._rendered, template_name, key, background))
+        return future
+
+    def _rendered(self, template_name, key, background, future):
+        if self._pending.get((template_name, key)) is not future:
+            # invalidated while rendering
+            return
+        del self._pending[template_name, key]
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            self.set(template_name, key, future.result())
+        elif background:
+            logger.error('Failed to refresh cached render of %r',
+                         template_name, exc_info=exc)
+
+    def set(self, template_name, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._entries[template_name, key] = _CacheEntry(value, expires)
+        self._entries.move_to_end((template_name, key))
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_variant(self, template_name, key, coding):
+        """Return cached output compressed with *coding*."""
+        entry = self._entries.get((template_name, key))
+        if entry is None:
+            return None
+        return entry.variants.get(coding)
+
+    def set_variant(self, template_name, key, coding, value):
+        entry = self._entries.get((template_name, key))
+        if entry is not None:
+            entry.variants[coding] = value
+
+    def invalidate(self, template_name=None):
+        """Drop cached renders of *template_name* or all of them."""
+        if template_name is None:
+            self._entries.clear()
+            self._pending.clear()
+            return
+        for entries in (self._entries, self._pending):
+            for entry_key in [entry_key for entry_key in entries
+                              if entry_key[0] == template_name]:
+                del entries[entry_key]
+
+
+def _get_render_cache(request, cache_key):
+    if cache_key is None:
+        return None
+    return request.app.get(APP_RENDER_CACHE_KEY)
+
+
+def _check_key_value(name, value):
+    """Fail on values which ``repr`` differs for every object."""
+    if isinstance(value, Mapping):
+        for item in value.values():
+            _check_key_value(name, item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            _check_key_value(name, item)
+    elif type(value).__repr__ is object.__repr__:
+        raise web.HTTPInternalServerError(
+            text=("Context value '{}' of {} has no meaningful repr, "
+                  "pass cache_key callable instead of True".format(
+                      name, type(value))))
+
+
+def _make_cache_key(request, context, cache_key):
+    if callable(cache_key):
+        return cache_key(request, context)
+    if cache_key is True:
+        # output of context processors is not part of the key
+        if not isinstance(context, Mapping):
+            raise web.HTTPInternalServerError(
+                text="context should be mapping, not {}".format(
+                    type(context)))
+        items = sorted(context.items())
+        for name, value in items:
+            _check_key_value(name, value)
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+    return cache_key
+
+
+def _get_fragment(template, fragment):
+    """Return cached :class:`mako.template.DefTemplate` of *template*."""
+    # kept on the template itself, every def refers to its parent so
+    # a weak mapping would never drop them
+    fragments = template.__dict__.setdefault('_aiohttp_mako_fragments', {})
+    try:
+        return fragments[fragment]
+    except KeyError:
+        pass
+    try:
+        def_template = template.get_def(fragment)
+    except AttributeError as e:
+        raise web.HTTPInternalServerError(
+            text="Fragment '{}' not found in template '{}'".format(
+                fragment, template.uri)) from e
+    fragments[fragment] = def_template
+    return def_template
+
+
+def _event_name(template_name, fragment):
+    if fragment is None:
+        return template_name
+    return '{}#{}'.format(template_name, fragment)
+
+
+def _render_string(template_name, request, context, app_key,
+                   encoding=None, fragment=None):
+    event = _start_render(request, _event_name(template_name, fragment))
+    try:
+        template = _get_template(template_name, request, app_key, event)
+        _check_lazy_processors(request, template)
+        if fragment is not None:
+            template = _get_fragment(template, fragment)
+        context = _get_context(request, context)
+        result = _render(template, context, event, encoding)
+    except Exception as exc:
+        if event is not None:
+            event.exception = exc
+            _finish_render(request, event)
+        raise
+    if event is not None:
+        event.size = len(result)
+        _finish_render(request, event)
+    return result
+
+
+class TemplateProcessPool(ProcessPoolExecutor):
+    """Process pool rendering templates in worker processes.
+
+    Every process builds own :class:`mako.lookup.TemplateLookup` from
+    *lookup_args* and *lookup_kwargs*, or :class:`CompiledTemplateLookup`
+    of *compiled* package, when it starts.  Only template name and handler
+    context are sent to it, so the context must be picklable.
+    """
+
+    def __init__(self, lookup_args=(), lookup_kwargs=None, compiled=None,
+                 **kwargs):
+        self._token = os.urandom(16).hex()
+        lookup_spec = (tuple(lookup_args), dict(lookup_kwargs or {}),
+                       compiled)
+        if sys.version_info >= (3, 7):
+            kwargs['initializer'] = functools.partial(
+                _init_process, self._token, lookup_spec,
+                kwargs.get('initializer'), kwargs.pop('initargs', ()))
+            self._lookup_spec = None
+        else:  # pragma: no cover
+            # no initializer, send lookup arguments with every render
+            self._lookup_spec = lookup_spec
+        super().__init__(**kwargs)
+
+
+_process_lookups = {}
+
+
+def _init_process(token, lookup_spec, initializer=None, initargs=()):
+    _process_lookups[token] = _make_lookup(*lookup_spec)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _process_render(token, lookup_spec, template_name, context,
+                    encoding=None, fragment=None):
+    lookup = _process_lookups.get(token)
+    if lookup is None:
+        lookup = _process_lookups[token] = _make_lookup(*lookup_spec)
+    try:
+        template = lookup.get_template(template_name)
+        if fragment is not None:
+            template = template.get_def(fragment)
+    except (TemplateLookupException, AttributeError):
+        raise _rendering_exception()
+    return _render(template, context, encoding=encoding)
+
+
+async def _render_in_process(executor, template_name, context,
+                             encoding=None, fragment=None):
+    """Render in :class:`TemplateProcessPool`, return output and time."""
+    context = dict(context)
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(
+            executor, _timed, _process_render, executor._token,
+            executor._lookup_spec, template_name, context, encoding,
+            fragment)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        for name, value in context.items():
+            try:
+                pickle.dumps(value)
+            except Exception:
+                raise MakoRenderingException(
+                    "Context value '{}' of {} can't be sent to process "
+                    "pool".format(name, type(value)))
+        raise
+
+
+class OffloadPolicy:
+    """Choose templates rendered in executor by their render times.
+
+    Templates which moving average of render time exceeds *budget*
+    seconds are rendered in executor, others in the event loop.
+    *smoothing* is weight of the last render time in the average.
+    """
+
+    def __init__(self, budget, smoothing=0.2):
+        self.budget = budget
+        self.smoothing = smoothing
+        self.averages = {}
+
+    def should_offload(self, template_name):
+        return self.averages.get(template_name, 0) > self.budget
+
+    def observe(self, template_name, seconds, inline=False):
+        average = self.averages.get(template_name)
+        if average is None:
+            average = seconds
+        else:
+            average += self.smoothing * (seconds - average)
+        self.averages[template_name] = average
+        if inline and seconds > self.budget:
+            logger.warning('Template %r blocked event loop for %.3f seconds, '
+                           'render budget is %.3f seconds',
+                           template_name, seconds, self.budget)
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+async def _render_string_async(template_name, request, context, app_key,
+                               executor, encoding=None, fragment=None):
+    name = _event_name(template_name, fragment)
+    event = _start_render(request, name)
+    try:
+        template = _get_template(template_name, request, app_key, event)
+        await _run_lazy_processors(request, template)
+        if fragment is not None:
+            template = _get_fragment(template, fragment)
+        handler_context = context
+        context = _get_context(request, context)
+        policy = request.app.get(APP_OFFLOAD_POLICY_KEY)
+        if executor is None and policy is not None and \
+                not policy.should_offload(name):
+            result, elapsed = _timed(_render, template, context, event,
+                                     encoding)
+            policy.observe(name, elapsed, inline=True)
+        else:
+            if executor is None:
+                executor = request.app.get(APP_EXECUTOR_KEY)
+                if policy is not None and \
+                        isinstance(executor, TemplateProcessPool):
+                    # the choice depends on timings, so it must not change
+                    # which context the template sees
+                    executor = None
+            if isinstance(executor, TemplateProcessPool):
+                # output of context processors often refers to objects
+                # of the request which can't be sent to another process
+                started = time.perf_counter()
+                result, elapsed = await _render_in_process(
+                    executor, template_name, handler_context, encoding,
+                    fragment)
+                if event is not None:
+                    event.render_time = time.perf_counter() - started
+            else:
+                loop = asyncio.get_event_loop()
+                result, elapsed = await loop.run_in_executor(
+                    executor, _timed, _render, template, context, event,
+                    encoding)
+            if policy is not None:
+                policy.observe(name, elapsed)
+    except Exception as exc:
+        if event is not None:
+            event.exception = exc
+            _finish_render(request, event)
+        raise
+    if event is not None:
+        event.size = len(result)
+        _finish_render(request, event)
+    return result
+
+
+def render_string(template_name, request, context, *, app_key,
+                  cache_key=None):
+    cache = _get_render_cache(request, cache_key)
+    if cache is None:
+        return _render_string(template_name, request, context, app_key)
+    key = (_make_cache_key(request, context, cache_key), None, None)
+    text = cache._get(template_name, key, functools.partial(
+        _render_string_async, template_name, request, context, app_key,
+        None))
+    if text is None:
+        text = _render_string(template_name, request, context, app_key)
+        cache.set(template_name, key, text)
     return text
 
 
+async def render_string_async(template_name, request, context, *,
+                              app_key=APP_KEY, executor=None, cache_key=None):
+    """Render template in executor, not blocking the event loop.
+
+    If *executor* is omitted the one passed to :func:`setup` is used,
+    falling back to the default executor of the loop.
+    """
+    context = await _resolve_context(context)
+    await run_context_processors(request, template_name, app_key=app_key)
+    cache = _get_render_cache(request, cache_key)
+    if cache is None:
+        return await _render_string_async(template_name, request, context,
+                                          app_key, executor)
+    key = (_make_cache_key(request, context, cache_key), None, None)
+    return await cache._get_or_render(template_name, key, functools.partial(
+        _render_string_async, template_name, request, context, app_key,
+        executor))
+
+
+RenderResult = namedtuple('RenderResult', 'index output exception')
+
+
+class _RenderBatch:
+    """Asynchronous iterator of :class:`RenderResult` of :func:`render_many`.
+
+    Takes next contexts from *contexts* only when less than *max_in_flight*
+    renders are in progress.
+    """
+
+    def __init__(self, render, contexts, max_in_flight, ordered):
+        self._render = render
+        self._contexts = enumerate(contexts)
+        self._max_in_flight = max_in_flight
+        self._ordered = ordered
+        self._pending = deque() if ordered else {}
+
+    def __aiter__(self):
+        return self
+
+    def _fill(self):
+        while len(self._pending) < self._max_in_flight:
+            try:
+                index, context = next(self._contexts)
+            except StopIteration:
+                return
+            future = asyncio.ensure_future(self._render(context))
+            if self._ordered:
+                self._pending.append((index, future))
+            else:
+                self._pending[future] = index
+
+    async def __anext__(self):
+        self._fill()
+        if not self._pending:
+            raise StopAsyncIteration
+        if self._ordered:
+            index, future = self._pending.popleft()
+            await asyncio.wait([future])
+        else:
+            done, pending = await asyncio.wait(
+                list(self._pending), return_when=asyncio.FIRST_COMPLETED)
+            future = done.pop()
+            index = self._pending.pop(future)
+        exc = future.exception()
+        if exc is not None:
+            return RenderResult(index, None, exc)
+        return RenderResult(index, future.result(), None)
+
+
+def render_many(app_or_lookup, template_name, contexts, *, app_key=APP_KEY,
+                executor=None, encoding=None, max_in_flight=None,
+                ordered=True):
+    """Render template with every context of *contexts* without request.
+
+    Returns asynchronous iterator of :class:`RenderResult`, failed renders
+    don't stop the batch.
+    """
+    if isinstance(app_or_lookup, web.Application):
+        lookup = app_or_lookup[app_key]
+        if executor is None:
+            executor = app_or_lookup.get(APP_EXECUTOR_KEY)
+    else:
+        lookup = app_or_lookup
+    template = lookup.get_template(template_name)
+    loop = asyncio.get_event_loop()
+    if isinstance(executor, TemplateProcessPool):
+        async def render(context):
+            result, elapsed = await _render_in_process(
+                executor, template_name, context, encoding)
+            return result
+    else:
+        def render(context):
+            return loop.run_in_executor(executor, _render, template,
+                                        context, None, encoding)
+    if max_in_flight is None:
+        max_in_flight = 2 * (getattr(executor, '_max_workers', None) or
+                             os.cpu_count() or 1)
+    return _RenderBatch(render, contexts, max_in_flight, ordered)
+
+
+def _get_cache_and_key(request, context, cache_key, encoding,
+                       fragment=None):
+    cache = _get_render_cache(request, cache_key)
+    if cache is None:
+        return None, None
+    return cache, (_make_cache_key(request, context, cache_key), encoding,
+                   fragment)
+
+
+def _render_body(template_name, request, context, app_key, encoding,
+                 cache, key, fragment=None):
+    if cache is None:
+        return _render_string(template_name, request, context, app_key,
+                              encoding, fragment)
+    body = cache._get(template_name, key, functools.partial(
+        _render_string_async, template_name, request, context, app_key,
+        None, encoding, fragment))
+    if body is None:
+        body = _render_string(template_name, request, context, app_key,
+                              encoding, fragment)
+        cache.set(template_name, key, body)
+    return body
+
+
+async def _render_body_async(template_name, request, context, app_key,
+                             encoding, cache, key, executor, fragment=None):
+    if cache is None:
+        return await _render_string_async(template_name, request, context,
+                                          app_key, executor, encoding,
+                                          fragment)
+    return await cache._get_or_render(template_name, key, functools.partial(
+        _render_string_async, template_name, request, context, app_key,
+        executor, encoding, fragment))
+
+
+_COMPRESSORS = OrderedDict()
+if brotli is not None:  # pragma: no cover
+    _COMPRESSORS['br'] = brotli.compress
+_COMPRESSORS['gzip'] = gzip.compress
+
+
+def _accepted_coding(request):
+    accepted = {}
+    header = request.headers.get(hdrs.ACCEPT_ENCODING, '')
+    for item in header.lower().split(','):
+        coding, _, params = item.partition(';')
+        params = params.strip()
+        quality = 1.0
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+    for coding in _COMPRESSORS:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def _response_coding(request, compress):
+    """Return content coding the response gets if it's long enough."""
+    if not compress:
+        return None
+    return _accepted_coding(request)
+
+
+def _compress(body, compress, coding, template_name, cache, key):
+    """Return content coding and body compressed with *coding*.
+
+    Compressed bodies are stored next to cached render.
+    """
+    min_size = COMPRESS_MIN_SIZE if compress is True else compress
+    if coding is None or len(body) < min_size:
+        return None, body
+    if cache is not None:
+        compressed = cache.get_variant(template_name, key, coding)
+        if compressed is not None:
+            return coding, compressed
+    compressed = _COMPRESSORS[coding](body)
+    if cache is not None:
+        cache.set_variant(template_name, key, coding, compressed)
+    return coding, compressed
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+
+
+def _get_validators(request, context, etag, last_modified):
+    """Return ``ETag`` and ``Last-Modified`` known before rendering."""
+    etag_value = None
+    if callable(etag):
+        etag_value = '"{}"'.format(etag(request, context))
+    if callable(last_modified):
+        last_modified = last_modified(request, context)
+    return etag_value, _to_datetime(last_modified)
+
+
+def _etag_matches(if_none_match, etag_value):
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value == '*' or value.replace('W/', '', 1) == etag_value:
+            return True
+    return False
+
+
+def _is_not_modified(request, etag_value, last_modified):
+    if request.method not in (hdrs.METH_GET, hdrs.METH_HEAD):
+        return False
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    if if_none_match is not None:
+        return (etag_value is not None and
+                _etag_matches(if_none_match, etag_value))
+    if_modified_since = request.if_modified_since
+    # Last-Modified header is rounded up to seconds by aiohttp
+    return (last_modified is not None and if_modified_since is not None and
+            math.ceil(last_modified.timestamp()) <=
+            if_modified_since.timestamp())
+
+
+def _set_validators(response, etag_value, last_modified, compress, coding):
+    if compress:
+        response.headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    if etag_value is not None:
+        if coding is not None:
+            # compressed representation is only semantically equivalent,
+            # 304 and 200 responses must send the same ETag whatever the
+            # size of the body is
+            etag_value = 'W/' + etag_value
+        response.headers[hdrs.ETAG] = etag_value
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _check_not_modified(request, etag, etag_value, last_modified, compress):
+    """Return 304 response if it's known before rendering."""
+    if etag is True and hdrs.IF_NONE_MATCH in request.headers:
+        return None
+    if etag_value is None and last_modified is None:
+        return None
+    if _is_not_modified(request, etag_value, last_modified):
+        return _set_validators(web.Response(status=304), etag_value,
+                               last_modified, compress,
+                               _response_coding(request, compress))
+    return None
+
+
+def _finish_response(request, body, encoding, status, etag, etag_value,
+                     last_modified, compress, template_name, cache, key):
+    if etag is True:
+        etag_value = '"{}"'.format(hashlib.sha1(body).hexdigest())
+    coding = _response_coding(request, compress)
+    if (etag_value is not None or last_modified is not None) and \
+            _is_not_modified(request, etag_value, last_modified):
+        return _set_validators(web.Response(status=304), etag_value,
+                               last_modified, compress, coding)
+    content_coding, body = _compress(body, compress, coding, template_name,
+                                     cache, key)
+    response = _make_response(body, encoding, status)
+    if content_coding is not None:
+        response.headers[hdrs.CONTENT_ENCODING] = content_coding
+    return _set_validators(response, etag_value, last_modified, compress,
+                           coding)
+
+
 def render_template(template_name, request, context, *,
-                    app_key=APP_KEY, encoding='utf-8'):
-    response = web.Response()
-    text = render_string(template_name, request, context, app_key=app_key)
+                    app_key=APP_KEY, encoding='utf-8', status=200,
+                    cache_key=None, etag=False, last_modified=None,
+                    compress=False, fragment=None):
+    etag_value, last_modified = _get_validators(request, context, etag,
+                                                last_modified)
+    response = _check_not_modified(request, etag, etag_value, last_modified,
+                                   compress)
+    if response is not None:
+        return response
+    cache, key = _get_cache_and_key(request, context, cache_key, encoding,
+                                    fragment)
+    body = _render_body(template_name, request, context, app_key, encoding,
+                        cache, key, fragment)
+    return _finish_response(request, body, encoding, status, etag,
+                            etag_value, last_modified, compress,
+                            template_name, cache, key)
+
+
+async def render_template_async(template_name, request, context, *,
+                                app_key=APP_KEY, encoding='utf-8',
+                                status=200, executor=None, cache_key=None,
+                                etag=False, last_modified=None,
+                                compress=False, fragment=None):
+    context = await _resolve_context(context)
+    await run_context_processors(request, template_name, app_key=app_key)
+    etag_value, last_modified = _get_validators(request, context, etag,
+                                                last_modified)
+    response = _check_not_modified(request, etag, etag_value, last_modified,
+                                   compress)
+    if response is not None:
+        return response
+    cache, key = _get_cache_and_key(request, context, cache_key, encoding,
+                                    fragment)
+    body = await _render_body_async(template_name, request, context,
+                                    app_key, encoding, cache, key, executor,
+                                    fragment)
+    return _finish_response(request, body, encoding, status, etag,
+                            etag_value, last_modified, compress,
+                            template_name, cache, key)
+
+
+def render_fragment(template_name, def_name, request, context, *,
+                    app_key=APP_KEY, encoding='utf-8', status=200, **kwargs):
+    """Render single ``<%def>`` or ``<%block>`` of template into response.
+
+    Other keyword arguments are the same as of :func:`render_template`.
+    """
+    return render_template(template_name, request, context, app_key=app_key,
+                           encoding=encoding, status=status,
+                           fragment=def_name, **kwargs)
+
+
+class _StreamClosed(Exception):
+    """Raised in rendering thread when nobody reads the stream anymore"""
+
+
+class _StreamBuffer:
+    """Mako output buffer passing encoded chunks to the event loop.
+
+    Used from the rendering thread, blocks while the queue is full so
+    rendering never runs ahead of the client.
+    """
+
+    def __init__(self, loop, queue, encoding, chunk_size):
+        self._loop = loop
+        self._queue = queue
+        self._encoder = codecs.getincrementalencoder(encoding)()
+        self._chunk_size = chunk_size
+        self._data = []
+        self._size = 0
+        self.written = 0
+        self.closed = False
+
+    def write(self, text):
+        self._data.append(text)
+        self._size += len(text)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def flush(self, final=False):
+        chunk = self._encoder.encode(''.join(self._data), final)
+        self._data = []
+        self._size = 0
+        if chunk:
+            self.written += len(chunk)
+            self._put(chunk)
+
+    def _put(self, item):
+        if self.closed:
+            raise _StreamClosed()
+        asyncio.run_coroutine_threadsafe(
+            self._queue.put(item), self._loop).result()
+
+
+def _render_to_buffer(template, context, buffer):
+    try:
+        try:
+            mako_context, kwargs = _make_mako_context(template, buffer,
+                                                      context)
+            template.render_context(mako_context, **kwargs)
+            buffer.flush(final=True)
+        except _StreamClosed:
+            pass
+        except Exception:
+            if not buffer.closed:
+                raise _rendering_exception()
+    finally:
+        if not buffer.closed:
+            buffer._put(None)
+
+
+async def render_stream(template_name, request, context, *, app_key=APP_KEY,
+                        encoding='utf-8', status=200,
+                        chunk_size=STREAM_CHUNK_SIZE, executor=None,
+                        fragment=None):
+    """Render template into :class:`aiohttp.web.StreamResponse` by chunks.
+
+    Template is rendered in *executor* while the handler writes produced
+    chunks to the client, response is prepared on the first chunk.
+    """
+    context = await _resolve_context(context)
+    event = _start_render(request, _event_name(template_name, fragment))
+    try:
+        response = await _render_stream(template_name, request, context,
+                                        app_key, encoding, status,
+                                        chunk_size, executor, event,
+                                        fragment)
+    except Exception as exc:
+        if event is not None:
+            event.exception = exc
+            _finish_render(request, event)
+        raise
+    if event is not None:
+        _finish_render(request, event)
+    return response
+
+
+async def _render_stream(template_name, request, context, app_key, encoding,
+                         status, chunk_size, executor, event,
+                         fragment=None):
+    template = _get_template(template_name, request, app_key, event)
+    await _run_lazy_processors(request, template)
+    if fragment is not None:
+        template = _get_fragment(template, fragment)
+    context = _get_context(request, context)
+    if executor is None:
+        # the thread is busy until the client receives the last chunk
+        executor = request.app.get(APP_STREAM_EXECUTOR_KEY,
+                                   request.app.get(APP_EXECUTOR_KEY))
+    if isinstance(executor, TemplateProcessPool):
+        # chunks can't be passed from another process, use threads
+        executor = None
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=1)
+    buffer = _StreamBuffer(loop, queue, encoding, chunk_size)
+    started = time.perf_counter()
+    fut = loop.run_in_executor(executor, _render_to_buffer,
+                               template, context, buffer)
+    response = web.StreamResponse(status=status)
     response.content_type = 'text/html'
     response.charset = encoding
-    response.text = text
+    try:
+        chunk = await queue.get()
+        while chunk is not None:
+            if not response.prepared:
+                await response.prepare(request)
+            await response.write(chunk)
+            chunk = await queue.get()
+        await fut
+    finally:
+        if not fut.done():
+            buffer.closed = True
+            while not queue.empty():
+                queue.get_nowait()
+    if not response.prepared:
+        await response.prepare(request)
+    await response.write_eof()
+    if event is not None:
+        event.render_time = time.perf_counter() - started
+        event.size = buffer.written
     return response
 
 
-def template(template_name, *, app_key=APP_KEY, encoding='utf-8', status=200):
+def template(template_name, *, app_key=APP_KEY, encoding='utf-8', status=200,
+             executor=None, stream=False, cache_key=None, etag=False,
+             last_modified=None, compress=False, fragment=None):
 
     def wrapper(func):
         @functools.wraps(func)
         async def wrapped(*args):
             context = await func(*args)
             request = args[-1]
-            response = render_template(template_name, request, context,
-                                       app_key=app_key, encoding=encoding)
-            response.set_status(status)
-            return response
+            if stream:
+                return await render_stream(template_name, request, context,
+                                           app_key=app_key,
+                                           encoding=encoding, status=status,
+                                           executor=executor,
+                                           fragment=fragment)
+            if executor is None and APP_EXECUTOR_KEY not in request.app \
+                    and APP_OFFLOAD_POLICY_KEY not in request.app:
+                context = await _resolve_context(context)
+                await run_context_processors(request, template_name,
+                                             app_key=app_key)
+                return render_template(template_name, request, context,
+                                       app_key=app_key, encoding=encoding,
+                                       status=status, cache_key=cache_key,
+                                       etag=etag,
+                                       last_modified=last_modified,
+                                       compress=compress, fragment=fragment)
+            return await render_template_async(
+                template_name, request, context, app_key=app_key,
+                encoding=encoding, status=status, executor=executor,
+                cache_key=cache_key, etag=etag,
+                last_modified=last_modified, compress=compress,
+                fragment=fragment)
+        wrapped._aiohttp_mako_template = (template_name, app_key, fragment)
         return wrapped
     return wrapper
 
@@ -89,13 +1998,179 @@ class MakoRenderingException(Exception):
     """Mako rendering exceptions with error """
 
 
+class MakoCompilationException(Exception):
+    """Templates failed to compile on warmup"""
+
+
+async def _run_processor(processor, request, timeout):
+    try:
+        return await asyncio.wait_for(processor(request), timeout)
+    except asyncio.TimeoutError:
+        logger.warning('Context processor %r timed out', processor)
+        return {}
+
+
+async def _gather_processors(request, processors):
+    timeout = request.app.get(APP_CONTEXT_PROCESSORS_TIMEOUT_KEY)
+    if timeout is None:
+        results = await asyncio.gather(
+            *[processor(request) for processor in processors])
+    else:
+        results = await asyncio.gather(
+            *[_run_processor(processor, request, timeout)
+              for processor in processors])
+    context = {}
+    for result in results:
+        context.update(result)
+    context.update(await _resolve_awaitables(context))
+    return context
+
+
 @web.middleware
 async def context_processors_middleware(request, handler):
-    request[REQUEST_CONTEXT_KEY] = {}
+    processors = []
+    lazy_processors = []
     for processor in request.app[APP_CONTEXT_PROCESSORS_KEY]:
-        request[REQUEST_CONTEXT_KEY].update(await processor(request))
+        if getattr(processor, 'provides', None) is None:
+            processors.append(processor)
+        else:
+            lazy_processors.append(processor)
+    request[REQUEST_CONTEXT_KEY] = await _gather_processors(request,
+                                                            processors)
+    request[REQUEST_LAZY_PROCESSORS_KEY] = lazy_processors
     return await handler(request)
 
 
+def provides(*names):
+    """Declare context variables produced by decorated context processor.
+
+    Such processor is run only when rendered template uses one of *names*.
+    """
+    def wrapper(processor):
+        processor.provides = frozenset(names)
+        return processor
+    return wrapper
+
+
+_ALL_KEYS = object()
+
+
+class CachedProcessor:
+    """Context processor caching results of *processor* per application.
+
+    Results are cached by value of *key* callable accepting ``request``,
+    one result per application if it is omitted.  *ttl* is results
+    lifetime in seconds, *maxsize* bounds number of cached keys.
+    Concurrent requests missing the same key wait for a single call of
+    *processor*.
+    """
+
+    def __init__(self, processor, ttl=None, key=None, maxsize=128):
+        functools.update_wrapper(self, processor)
+        self.processor = processor
+        self.ttl = ttl
+        self.key = key
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = weakref.WeakKeyDictionary()
+        self._pending = {}
+
+    async def __call__(self, request):
+        app = request.app
+        key = None
+        if self.key is not None:
+            key = self.key(request)
+            if inspect.isawaitable(key):
+                key = await key
+        entries = self._entries.get(app)
+        if entries is None:
+            entries = self._entries[app] = OrderedDict()
+        entry = entries.get(key)
+        if entry is not None and (entry.expires is None or
+                                  entry.expires > time.monotonic()):
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+        self.misses += 1
+        future = self._pending.get((app, key))
+        if future is None:
+            future = self._pending[app, key] = asyncio.ensure_future(
+                self._call(request))
+            future.add_done_callback(functools.partial(
+                self._called, entries, app, key))
+        return await asyncio.shield(future)
+
+    async def _call(self, request):
+        result = await self.processor(request)
+        resolved = await _resolve_awaitables(result)
+        if resolved:
+            result = dict(result, **resolved)
+        return result
+
+    def _called(self, entries, app, key, future):
+        if self._pending.get((app, key)) is not future:
+            # invalidated while running
+            return
+        del self._pending[app, key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        entries[key] = _CacheEntry(future.result(), expires)
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def invalidate(self, app=None, key=_ALL_KEYS):
+        """Drop cached results of *key*, all results if it is omitted.
+
+        Only results of *app* are dropped if it is passed.
+        """
+        apps = list(self._entries) if app is None else [app]
+        for pending in list(self._pending):
+            if pending[0] in apps and (key is _ALL_KEYS or
+                                       pending[1] == key):
+                del self._pending[pending]
+        for app in apps:
+            entries = self._entries.get(app)
+            if entries is None:
+                continue
+            if key is _ALL_KEYS:
+                entries.clear()
+            else:
+                entries.pop(key, None)
+
+
+def cached_processor(ttl=None, *, key=None, maxsize=128):
+    """Cache results of decorated context processor, see
+    :class:`CachedProcessor`.
+    """
+    def wrapper(processor):
+        return CachedProcessor(processor, ttl=ttl, key=key, maxsize=maxsize)
+    return wrapper
+
+
 async def request_processor(request):
     return {'request': request}
+
+
+async def render_stats_handler(request):
+    """Serve :class:`RenderStats` of the application in Prometheus format.
+
+    Statistics of :class:`TemplateCache` of lookups are served too.
+    """
+    app = request.app
+    stats = app.get(APP_RENDER_STATS_KEY)
+    if stats is None:
+        raise web.HTTPInternalServerError(
+            text=("Render stats are not enabled, "
+                  "call aiohttp_mako.setup(stats=True) first"))
+    caches = []
+    for app_key in sorted(app.get(APP_TEMPLATE_GRAPHS_KEY, ())):
+        cache = getattr(app.get(app_key), '_collection', None)
+        if isinstance(cache, TemplateCache):
+            caches.append((app_key, cache.stats()))
+    text = stats.prometheus() + template_cache_prometheus(caches)
+    return web.Response(
+        body=text.encode('utf-8'),
+        headers={hdrs.CONTENT_TYPE: PROMETHEUS_CONTENT_TYPE})
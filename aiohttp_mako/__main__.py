@@ -0,0 +1,69 @@
+"""Command line tools of aiohttp_mako.
+
+Compile templates into importable package shipped with the application::
+
+    python -m aiohttp_mako compile templates --output build --package tpl
+
+and pass it to :func:`aiohttp_mako.setup` as ``compiled='tpl'``.
+"""
+import argparse
+import logging
+import sys
+
+from mako.lookup import TemplateLookup
+
+from . import MakoCompilationException, compile_templates
+
+
+def compile_command(args):
+    lookup = TemplateLookup(directories=args.directories,
+                            input_encoding=args.input_encoding,
+                            default_filters=args.default_filters,
+                            imports=args.imports,
+                            strict_undefined=args.strict_undefined)
+    try:
+        count = compile_templates(lookup, args.output, args.package,
+                                  args.patterns or ('*',), pyc=args.pyc)
+    except MakoCompilationException as e:
+        print(e, file=sys.stderr)
+        return 1
+    print('Compiled {} templates into package {}'.format(
+        count, args.package))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m aiohttp_mako',
+                                     description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    compile_parser = commands.add_parser(
+        'compile', help='compile templates into importable package')
+    compile_parser.add_argument('directories', nargs='+',
+                                help='template directories')
+    compile_parser.add_argument('-o', '--output', default='.',
+                                help='directory to write package into')
+    compile_parser.add_argument('-p', '--package', required=True,
+                                help='name of compiled package')
+    compile_parser.add_argument('--pattern', dest='patterns',
+                                action='append',
+                                help='compile only templates matching the '
+                                     'pattern, may be repeated')
+    compile_parser.add_argument('--pyc', action='store_true',
+                                help='write .pyc files too')
+    compile_parser.add_argument('--input-encoding', default='utf-8')
+    compile_parser.add_argument('--default-filter', dest='default_filters',
+                                action='append',
+                                help='Mako default filter, may be repeated')
+    compile_parser.add_argument('--import', dest='imports', action='append',
+                                help='Python import line added to every '
+                                     'template, may be repeated')
+    compile_parser.add_argument('--strict-undefined', action='store_true')
+    compile_parser.set_defaults(func=compile_command)
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
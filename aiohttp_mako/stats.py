@@ -0,0 +1,180 @@
+import bisect
+import math
+import threading
+from collections import namedtuple
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+MemoryUsage = namedtuple('MemoryUsage', 'rss pss shared private')
+
+
+def memory_usage(pid='self'):
+    """Return :class:`MemoryUsage` of process *pid* in bytes.
+
+    *shared* is resident memory shared with other processes, e.g. pages of
+    forked workers not written since fork, *private* is memory unique to
+    the process.  Reads ``/proc/<pid>/smaps_rollup`` falling back to slower
+    ``smaps``, so works on Linux only.
+    """
+    try:
+        fp = open('/proc/{}/smaps_rollup'.format(pid))
+    except FileNotFoundError:
+        fp = open('/proc/{}/smaps'.format(pid))
+    fields = {}
+    with fp:
+        for line in fp:
+            name, sep, value = line.partition(':')
+            if sep and value.endswith(' kB\n'):
+                fields[name] = fields.get(name, 0) + int(value[:-4]) * 1024
+    return MemoryUsage(
+        rss=fields.get('Rss', 0), pss=fields.get('Pss', 0),
+        shared=fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        private=(fields.get('Private_Clean', 0) +
+                 fields.get('Private_Dirty', 0)))
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yield upper bounds of buckets with numbers of observations."""
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            yield bound, total
+
+
+class TemplateStats:
+    """Counters and histograms of a single template."""
+
+    def __init__(self):
+        self.renders = 0
+        self.errors = 0
+        self.lookup_time = Histogram(TIME_BUCKETS)
+        self.compile_time = Histogram(TIME_BUCKETS)
+        self.render_time = Histogram(TIME_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+
+
+_METRICS = (
+    ('lookup_time', 'aiohttp_mako_lookup_seconds',
+     'Time of getting template from lookup.'),
+    ('compile_time', 'aiohttp_mako_compile_seconds',
+     'Time of compiling template.'),
+    ('render_time', 'aiohttp_mako_render_seconds',
+     'Time of rendering template.'),
+    ('size', 'aiohttp_mako_output_size',
+     'Size of rendered output.'),
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class RenderStats:
+    """Observer collecting per template render statistics.
+
+    Pass it to :func:`aiohttp_mako.setup` with ``observers`` argument or
+    use ``stats=True``.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def on_render_start(self, request, event):
+        pass
+
+    def on_render_done(self, request, event):
+        with self._lock:
+            stats = self.templates.get(event.template_name)
+            if stats is None:
+                stats = self.templates[event.template_name] = TemplateStats()
+            stats.renders += 1
+            if event.exception is not None:
+                stats.errors += 1
+            for attr, name, help in _METRICS:
+                value = getattr(event, attr)
+                if value is not None:
+                    getattr(stats, attr).observe(value)
+
+    def prometheus(self):
+        """Return statistics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            templates = sorted(self.templates.items())
+            for attr, name in (('renders', 'aiohttp_mako_renders_total'),
+                               ('errors', 'aiohttp_mako_errors_total')):
+                lines.append('# TYPE {} counter'.format(name))
+                for template_name, stats in templates:
+                    lines.append('{}{{template="{}"}} {}'.format(
+                        name, _escape(template_name), getattr(stats, attr)))
+            for attr, name, help in _METRICS:
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} histogram'.format(name))
+                for template_name, stats in templates:
+                    label = 'template="{}"'.format(_escape(template_name))
+                    histogram = getattr(stats, attr)
+                    for bound, count in histogram.cumulative():
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                            name, label, _format_value(bound), count))
+                    lines.append('{}_sum{{{}}} {}'.format(
+                        name, label, _format_value(histogram.sum)))
+                    lines.append('{}_count{{{}}} {}'.format(
+                        name, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+_TEMPLATE_CACHE_METRICS = (
+    ('entries', 'aiohttp_mako_template_cache_entries', 'gauge'),
+    ('bytes', 'aiohttp_mako_template_cache_bytes', 'gauge'),
+    ('maxbytes', 'aiohttp_mako_template_cache_max_bytes', 'gauge'),
+    ('hits', 'aiohttp_mako_template_cache_hits_total', 'counter'),
+    ('misses', 'aiohttp_mako_template_cache_misses_total', 'counter'),
+    ('evictions', 'aiohttp_mako_template_cache_evictions_total', 'counter'),
+    ('compile_time', 'aiohttp_mako_template_cache_compile_seconds_total',
+     'counter'),
+    ('recompiles', 'aiohttp_mako_template_cache_recompiles_total',
+     'counter'),
+    ('recompile_time', 'aiohttp_mako_template_cache_recompile_seconds_total',
+     'counter'),
+)
+
+
+def template_cache_prometheus(caches):
+    """Return statistics of template caches in Prometheus text format.
+
+    *caches* are pairs of lookup key and ``TemplateCache.stats()``.
+    """
+    lines = []
+    if caches:
+        for attr, name, metric_type in _TEMPLATE_CACHE_METRICS:
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for app_key, stats in caches:
+                lines.append('{}{{lookup="{}"}} {}'.format(
+                    name, _escape(app_key), _format_value(stats[attr])))
+    return ''.join(line + '\n' for line in lines)
@@ -0,0 +1,65 @@
+"""Cost of merging context processors output into template context.
+
+Compares the former ``dict(request_context, **context)`` merge followed by
+``template.render_unicode(**context)`` with rendering a :class:`ChainMap`
+of both by ``aiohttp_mako``::
+
+    python benchmarks/bench_context_merge.py
+"""
+import timeit
+import tracemalloc
+from collections import ChainMap
+
+from mako.lookup import TemplateLookup
+
+import aiohttp_mako
+
+
+def make_template():
+    lookup = TemplateLookup()
+    lookup.put_string('page.html', '<h1>${head}</h1>${len(rows)}')
+    return lookup.get_template('page.html')
+
+
+def make_context(size):
+    processors_context = {'processor_{}'.format(i): i for i in range(size)}
+    context = {'key_{}'.format(i): i for i in range(size)}
+    context.update(head='HEAD', rows=list(range(10000)))
+    return processors_context, context
+
+
+def render_copy(template, processors_context, context):
+    merged = dict(processors_context, **context)
+    return template.render_unicode(**merged)
+
+
+def render_layered(template, processors_context, context):
+    return aiohttp_mako._render(template,
+                                ChainMap(context, processors_context))
+
+
+def measure(func, *args):
+    func(*args)
+    tracemalloc.start()
+    func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = min(timeit.repeat(lambda: func(*args), number=200, repeat=5))
+    return peak, seconds / 200
+
+
+def main():
+    template = make_template()
+    print('{:>8} {:>10} {:>14} {:>14}'.format(
+        'keys', 'merge', 'peak bytes', 'usec/render'))
+    for size in (10, 100, 1000, 10000):
+        processors_context, context = make_context(size)
+        for func in (render_copy, render_layered):
+            peak, seconds = measure(func, template, processors_context,
+                                    context)
+            print('{:>8} {:>10} {:>14} {:>14.1f}'.format(
+                size, func.__name__[7:], peak, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
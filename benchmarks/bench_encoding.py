@@ -0,0 +1,56 @@
+"""Peak memory of rendering template into response body.
+
+Compares rendering text and encoding it by assigning ``response.text``
+with rendering directly into encoded body::
+
+    python benchmarks/bench_encoding.py
+"""
+import tracemalloc
+
+from aiohttp import web
+from mako.lookup import TemplateLookup
+
+import aiohttp_mako
+
+
+def make_template():
+    lookup = TemplateLookup()
+    lookup.put_string('rows.html',
+                      '% for row in rows:\n<p>${row} ☃</p>\n% endfor\n')
+    return lookup.get_template('rows.html')
+
+
+def render_text(template, context):
+    response = web.Response(content_type='text/html', charset='utf-8')
+    response.text = template.render_unicode(**context)
+    return response
+
+
+def render_body(template, context):
+    body = aiohttp_mako._render(template, context, encoding='utf-8')
+    return aiohttp_mako._make_response(body, 'utf-8')
+
+
+def measure(func, *args):
+    func(*args)
+    tracemalloc.start()
+    response = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(response.body), peak
+
+
+def main():
+    template = make_template()
+    print('{:>8} {:>8} {:>12} {:>12} {:>6}'.format(
+        'rows', 'render', 'body bytes', 'peak bytes', 'ratio'))
+    for rows in (1000, 10000, 100000):
+        context = {'rows': range(rows)}
+        for func in (render_text, render_body):
+            size, peak = measure(func, template, context)
+            print('{:>8} {:>8} {:>12} {:>12} {:>6.2f}'.format(
+                rows, func.__name__[7:], size, peak, peak / size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Memory of forked workers with templates compiled before or after fork.
+
+Every worker renders all templates and reports its memory, Linux only::
+
+    python benchmarks/bench_prefork.py --templates 500 --workers 4
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from mako.lookup import TemplateLookup
+
+import aiohttp_mako
+
+TEMPLATE = """<html><body><h1>${head}</h1>
+% for row in rows:
+<p class="row-INDEX">${row} ${row * INDEX}</p>
+% endfor
+<%def name="footer(text)"><footer>${text} INDEX</footer></%def>
+${footer(head)}
+</body></html>"""
+
+
+def make_templates(directory, count):
+    for index in range(count):
+        path = os.path.join(directory, 'page{}.html'.format(index))
+        with open(path, 'w') as fp:
+            fp.write(TEMPLATE.replace('INDEX', str(index)))
+
+
+def worker(lookup, count, fd):
+    for index in range(count):
+        template = lookup.get_template('page{}.html'.format(index))
+        aiohttp_mako._render(template, {'head': 'HEAD', 'rows': range(10)})
+    os.write(fd, json.dumps(aiohttp_mako.memory_usage()._asdict()).encode())
+    os._exit(0)
+
+
+def master(directory, args, preload):
+    lookup = TemplateLookup(directories=[directory], filesystem_checks=False)
+    if preload:
+        aiohttp_mako.preload(lookup)
+    results = []
+    for i in range(args.workers):
+        read_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            os.close(read_fd)
+            worker(lookup, args.templates, write_fd)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fp:
+            results.append(json.loads(fp.read()))
+    for i in range(args.workers):
+        os.wait()
+    return results
+
+
+def run(directory, args, preload):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, json.dumps(master(directory, args,
+                                             preload)).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        results = json.loads(fp.read())
+    os.waitpid(pid, 0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--templates', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_templates(directory, args.templates)
+        print('{:>8} {:>6} {:>10} {:>10} {:>10}'.format(
+            'mode', 'worker', 'rss KiB', 'shared KiB', 'private KiB'))
+        for preload in (False, True):
+            mode = 'preload' if preload else 'lazy'
+            for i, usage in enumerate(run(directory, args, preload)):
+                print('{:>8} {:>6} {:>10} {:>10} {:>10}'.format(
+                    mode, i, usage['rss'] // 1024, usage['shared'] // 1024,
+                    usage['private'] // 1024))
+
+
+if __name__ == '__main__':
+    main()
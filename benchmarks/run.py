@@ -0,0 +1,197 @@
+"""Benchmarks of aiohttp_mako render pipeline.
+
+Run all benchmarks and print results, optionally saving them as JSON for
+comparing between releases::
+
+    python benchmarks/run.py --json results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+
+import aiohttp
+import mako
+from aiohttp import web
+from aiohttp.test_utils import TestServer, make_mocked_request
+
+import aiohttp_mako
+
+TEMPLATE = """<html><body><h1>${head}</h1>
+<table>
+% for row in rows:
+<tr><td>${row['id']}</td><td>${row['name']}</td><td>${row['value']}</td></tr>
+% endfor
+</table></body></html>"""
+
+SIZES = {'small': 10, 'medium': 1000, 'huge': 100000}
+
+
+def make_rows(count):
+    return [{'id': i, 'name': 'name {}'.format(i), 'value': i * 3.14}
+            for i in range(count)]
+
+
+def make_app(**kwargs):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, **kwargs)
+    lookup.put_string('page.html', TEMPLATE)
+    return app
+
+
+def bench(func, min_time):
+    """Return best seconds per call of *func*."""
+    func()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return elapsed / number
+        number *= 2
+
+
+async def bench_async(func, min_time):
+    await func()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for i in range(number):
+            await func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return elapsed / number
+        number *= 2
+
+
+def bench_render_string(min_time):
+    app = make_app()
+    request = make_mocked_request('GET', '/', app=app)
+    results = {}
+    for name, count in SIZES.items():
+        context = {'head': 'HEAD', 'rows': make_rows(count)}
+        seconds = bench(lambda: aiohttp_mako.render_string(
+            'page.html', request, context, app_key=aiohttp_mako.APP_KEY),
+            min_time)
+        results[name] = {'rows': count, 'seconds': seconds,
+                         'renders_per_second': 1 / seconds}
+    return results
+
+
+async def bench_template_overhead(min_time):
+    app = make_app()
+    request = make_mocked_request('GET', '/', app=app)
+    template = aiohttp_mako.get_lookup(app).get_template('page.html')
+    context = {'head': 'HEAD', 'rows': make_rows(SIZES['small'])}
+
+    @aiohttp_mako.template('page.html')
+    async def handler(request):
+        return context
+
+    direct = bench(lambda: template.render_unicode(**context), min_time)
+    decorated = await bench_async(lambda: handler(request), min_time)
+    return {'mako_seconds': direct, 'template_seconds': decorated,
+            'overhead_seconds': decorated - direct}
+
+
+async def bench_context_processors(min_time):
+    results = {}
+    for count in (0, 1, 5, 20):
+        processors = []
+        for i in range(count):
+            async def processor(request, i=i):
+                return {'processor_{}'.format(i): i}
+            processors.append(processor)
+        app = make_app(context_processors=processors)
+        request = make_mocked_request('GET', '/', app=app)
+
+        async def handler(request):
+            return None
+
+        if processors:
+            middleware = aiohttp_mako.context_processors_middleware
+            seconds = await bench_async(
+                lambda: middleware(request, handler), min_time)
+        else:
+            seconds = await bench_async(lambda: handler(request), min_time)
+        results[str(count)] = {'seconds': seconds}
+    return results
+
+
+async def bench_server(requests, concurrency):
+    app = make_app()
+
+    @aiohttp_mako.template('page.html')
+    async def handler(request):
+        return {'head': 'HEAD', 'rows': make_rows(SIZES['medium'])}
+
+    app.router.add_get('/', handler)
+    latencies = []
+    async with TestServer(app) as server:
+        url = server.make_url('/')
+        async with aiohttp.ClientSession() as session:
+            queue = asyncio.Queue()
+            for i in range(requests):
+                queue.put_nowait(i)
+
+            async def worker():
+                while not queue.empty():
+                    queue.get_nowait()
+                    started = time.perf_counter()
+                    async with session.get(url) as resp:
+                        await resp.read()
+                        assert resp.status == 200, resp.status
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for i in range(concurrency)])
+            elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {'requests': requests, 'concurrency': concurrency,
+            'requests_per_second': requests / elapsed,
+            'p50_seconds': latencies[len(latencies) // 2],
+            'p99_seconds': latencies[int(len(latencies) * 0.99)]}
+
+
+async def run(args):
+    return {
+        'environment': {
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'aiohttp': aiohttp.__version__,
+            'mako': mako.__version__,
+            'aiohttp_mako': aiohttp_mako.__version__,
+        },
+        'render_string': bench_render_string(args.min_time),
+        'template_overhead': await bench_template_overhead(args.min_time),
+        'context_processors': await bench_context_processors(args.min_time),
+        'server': await bench_server(args.requests, args.concurrency),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', help='save results into JSON file')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimal time of every micro benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
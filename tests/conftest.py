@@ -7,12 +7,22 @@ from aiohttp import web
 
 
 @pytest.fixture
-def app():
-    app = web.Application()
-    lookup = aiohttp_mako.setup(app, input_encoding='utf-8',
-                                output_encoding='utf-8',
-                                default_filters=['decode.utf8'])
+def make_app():
 
+    def make_app(templates=(), **kwargs):
+        """Create application with *templates* mapping names to sources."""
+        app = web.Application()
+        lookup = aiohttp_mako.setup(app, **kwargs)
+        for name, source in dict(templates).items():
+            lookup.put_string(name, source)
+        return app
+
+    return make_app
+
+
+@pytest.fixture
+def app(make_app):
     tplt = "<html><body><h1>${head}</h1>${text}</body></html>"
-    lookup.put_string('tplt.html', tplt)
-    return app
+    return make_app({'tplt.html': tplt}, input_encoding='utf-8',
+                    output_encoding='utf-8',
+                    default_filters=['decode.utf8'])
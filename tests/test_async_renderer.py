@@ -0,0 +1,147 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+async def test_render_template_async(app, aiohttp_client):
+
+    async def func(request):
+        return await aiohttp_mako.render_template_async(
+            'tplt.html', request, {'head': 'HEAD', 'text': 'text'})
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>text</body></html>' == txt
+
+
+async def test_template_executor(app, aiohttp_client):
+    executor = ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix='mako-render')
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('thread.html', '${name()}')
+
+    def name():
+        return threading.current_thread().name
+
+    @aiohttp_mako.template('thread.html', executor=executor)
+    async def func(request):
+        return {'name': name}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert txt.startswith('mako-render')
+    executor.shutdown()
+
+
+async def test_setup_executor(aiohttp_client):
+    executor = ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix='mako-setup')
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, executor=executor)
+    lookup.put_string('thread.html', '${name()}')
+
+    @aiohttp_mako.template('thread.html')
+    async def func(request):
+        return {'name': lambda: threading.current_thread().name}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    txt = await resp.text()
+    assert txt.startswith('mako-setup')
+    executor.shutdown()
+
+
+async def test_render_string_async_error(app):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('broken.html', '${1 / 0}')
+    req = make_mocked_request('GET', '/', app=app)
+
+    with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+        await aiohttp_mako.render_string_async('broken.html', req, {})
+
+    assert 'ZeroDivisionError' in str(ctx.value)
+
+
+async def test_process_pool(tmp_path, aiohttp_client):
+    (tmp_path / 'pid.html').write_text('${head} ${os.getpid()}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)],
+                       imports=['import os'], processes=1)
+
+    @aiohttp_mako.template('pid.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    head, pid = (await resp.text()).split()
+    assert 'HEAD' == head
+    assert os.getpid() != int(pid)
+
+
+async def test_process_pool_request_processor(tmp_path, aiohttp_client):
+    (tmp_path / 'head.html').write_text('${head}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)], processes=1,
+                       context_processors=[aiohttp_mako.request_processor])
+
+    @aiohttp_mako.template('head.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    for i in range(2):
+        resp = await client.get('/')
+        assert 200 == resp.status
+        assert 'HEAD' == await resp.text()
+
+
+async def test_process_pool_not_picklable(tmp_path):
+    (tmp_path / 'head.html').write_text('${head}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)])
+    req = make_mocked_request('GET', '/', app=app)
+
+    pool = aiohttp_mako.TemplateProcessPool(
+        lookup_kwargs={'directories': [str(tmp_path)]}, max_workers=1)
+    with pool:
+        with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+            await aiohttp_mako.render_string_async(
+                'head.html', req, {'head': 'HEAD', 'lock': threading.Lock()},
+                executor=pool)
+
+    assert "Context value 'lock'" in str(ctx.value)
+
+
+async def test_process_pool_error(tmp_path):
+    (tmp_path / 'broken.html').write_text('${1 / 0}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)])
+    req = make_mocked_request('GET', '/', app=app)
+
+    pool = aiohttp_mako.TemplateProcessPool(
+        lookup_kwargs={'directories': [str(tmp_path)]}, max_workers=1)
+    with pool:
+        with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+            await aiohttp_mako.render_string_async('broken.html', req, {},
+                                                   executor=pool)
+
+    assert 'ZeroDivisionError' in str(ctx.value)
+    assert 'line 1' in str(ctx.value)
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+running = []
+
+
+async def fetch(value, delay=0.01):
+    running.append(value)
+    await asyncio.sleep(delay)
+    concurrent = len(running)
+    await asyncio.sleep(0)
+    running.remove(value)
+    return value, concurrent
+
+
+async def test_template_awaitables(app, aiohttp_client):
+
+    async def text():
+        return await fetch('text')
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {'head': fetch('HEAD'), 'text': text}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert "<html><body><h1>('HEAD', 2)</h1>('text', 2)</body></html>" == txt
+
+
+async def test_render_string_async_awaitables(app):
+    req = make_mocked_request('GET', '/', app=app)
+    context = {'head': fetch('HEAD'), 'text': 'text'}
+
+    txt = await aiohttp_mako.render_string_async('tplt.html', req, context)
+
+    assert "<html><body><h1>('HEAD', 1)</h1>text</body></html>" == txt
+
+
+async def test_render_awaitable_error(app):
+    req = make_mocked_request('GET', '/', app=app)
+    slow = asyncio.ensure_future(fetch('text', 10))
+
+    async def broken():
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        await aiohttp_mako.render_template_async(
+            'tplt.html', req, {'head': broken, 'text': slow})
+
+    await asyncio.sleep(0)
+    assert slow.cancelled()
+
+
+async def test_context_processor_awaitables(aiohttp_client):
+
+    async def processor(request):
+        return {'head': asyncio.sleep(0, 'HEAD')}
+
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, context_processors=[processor])
+    lookup.put_string('tplt.html', '<h1>${head}</h1>')
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert '<h1>HEAD</h1>' == await resp.text()
@@ -0,0 +1,122 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+TEMPLATES = {'tplt.html': '${menu} ${user}', 'plain.html': 'plain'}
+
+
+def add_routes(app):
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {}
+
+    @aiohttp_mako.template('plain.html')
+    async def plain(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+    app.router.add_route('GET', '/plain', plain)
+    return app
+
+
+async def test_cached_per_app(make_app, aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.cached_processor(ttl=60)
+    async def menu(request):
+        calls.append(1)
+        return {'menu': len(calls), 'user': request.query.get('user')}
+
+    app = make_app(TEMPLATES, context_processors=[menu])
+    client = await aiohttp_client(add_routes(app))
+    for user in ('bob', 'alice'):
+        resp = await client.get('/', params={'user': user})
+        assert '1 bob' == await resp.text()
+    assert 1 == menu.hits
+    assert 1 == menu.misses
+
+    menu.invalidate()
+    resp = await client.get('/', params={'user': 'alice'})
+    assert '2 alice' == await resp.text()
+
+
+async def test_cached_per_key(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(aiohttp_mako.time, 'monotonic', lambda: now[0])
+    calls = []
+
+    @aiohttp_mako.cached_processor(
+        ttl=10, key=lambda request: request.query['user'], maxsize=2)
+    async def user(request):
+        calls.append(request.query['user'])
+        return {'user': request.query['user']}
+
+    app = web.Application()
+
+    async def call(name):
+        req = make_mocked_request('GET', '/?user=' + name, app=app)
+        return await user(req)
+
+    assert {'user': 'bob'} == await call('bob')
+    assert {'user': 'alice'} == await call('alice')
+    assert {'user': 'bob'} == await call('bob')
+    assert ['bob', 'alice'] == calls
+
+    await call('eve')
+    await call('alice')
+    assert ['bob', 'alice', 'eve', 'alice'] == calls
+
+    now[0] += 11
+    await call('eve')
+    assert 'eve' == calls[-1]
+
+    user.invalidate(app, 'eve')
+    await call('eve')
+    assert ['eve', 'eve'] == calls[-2:]
+
+
+async def test_cached_coalesced():
+    calls = []
+
+    @aiohttp_mako.cached_processor()
+    async def slow(request):
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'value': asyncio.sleep(0, 'resolved')}
+
+    app = web.Application()
+    req = make_mocked_request('GET', '/', app=app)
+    results = await asyncio.gather(*[slow(req) for i in range(5)])
+
+    assert [{'value': 'resolved'}] * 5 == results
+    assert 1 == len(calls)
+    assert {'value': 'resolved'} == await slow(req)
+
+
+async def test_cached_lazy(make_app, aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('menu')
+    @aiohttp_mako.cached_processor()
+    async def menu(request):
+        calls.append(1)
+        return {'menu': 'MENU'}
+
+    @aiohttp_mako.cached_processor()
+    @aiohttp_mako.provides('user')
+    async def user(request):
+        return {'user': 'USER'}
+
+    assert frozenset(['user']) == user.provides
+    app = make_app(TEMPLATES, context_processors=[menu, user])
+    client = await aiohttp_client(add_routes(app))
+    resp = await client.get('/plain')
+    assert 'plain' == await resp.text()
+    assert [] == calls
+    resp = await client.get('/')
+    assert 'MENU USER' == await resp.text()
@@ -0,0 +1,82 @@
+import pytest
+
+from aiohttp import web
+from mako.lexer import Lexer
+from mako.lookup import TemplateLookup
+
+import aiohttp_mako
+from aiohttp_mako.__main__ import main
+
+
+@pytest.fixture
+def templates(tmp_path):
+    directory = tmp_path / 'templates'
+    (directory / 'emails').mkdir(parents=True)
+    (directory / 'base.html').write_text('<body>${self.body()}</body>')
+    (directory / 'index.html').write_text(
+        '<%inherit file="base.html"/><h1>${head}</h1>')
+    (directory / 'emails' / 'welcome.txt').write_text('Hello ${name}')
+    return directory
+
+
+def test_compile_command(templates, tmp_path, monkeypatch, capsys):
+    output = tmp_path / 'build'
+    assert 0 == main(['compile', str(templates), '-o', str(output),
+                      '-p', 'compiled_cli', '--pattern', '*.html', '--pyc'])
+    assert 'Compiled 2 templates' in capsys.readouterr().out
+
+    monkeypatch.syspath_prepend(str(output))
+    lookup = aiohttp_mako.CompiledTemplateLookup('compiled_cli')
+    assert {'base.html': '_base_html',
+            'index.html': '_index_html'} == lookup.modules
+    assert list((output / 'compiled_cli' / '__pycache__').glob('*.pyc'))
+
+
+def test_compile_command_failed(templates, tmp_path, capsys):
+    (templates / 'broken.html').write_text('% for x in y:\n')
+    assert 1 == main(['compile', str(templates), '-o', str(tmp_path),
+                      '-p', 'compiled_broken'])
+    assert 'broken.html' in capsys.readouterr().err
+
+
+async def test_setup_compiled(templates, tmp_path, monkeypatch,
+                              aiohttp_client):
+    lookup = TemplateLookup(directories=[str(templates)])
+    assert 3 == aiohttp_mako.compile_templates(lookup, str(tmp_path),
+                                               'compiled_setup')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    def parse(self):
+        raise AssertionError('template is compiled at runtime')
+
+    monkeypatch.setattr(Lexer, 'parse', parse)
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, compiled='compiled_setup')
+
+    @aiohttp_mako.template('index.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert '<body><h1>HEAD</h1></body>' == await resp.text()
+    assert lookup.get_template('/emails/welcome.txt').render(
+        name='Bob') == 'Hello Bob'
+
+
+def test_compiled_error(tmp_path, monkeypatch):
+    (tmp_path / 'broken.html').write_text('<h1>\n${1 / 0}</h1>')
+    lookup = TemplateLookup(directories=[str(tmp_path)])
+    aiohttp_mako.compile_templates(lookup, str(tmp_path), 'compiled_error')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    app = web.Application()
+    aiohttp_mako.setup(app, compiled='compiled_error')
+    template = aiohttp_mako.get_lookup(app).get_template('broken.html')
+    with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+        aiohttp_mako._render(template, {})
+
+    assert 'File "broken.html", line 2' in str(ctx.value)
+    assert 'ZeroDivisionError' in str(ctx.value)
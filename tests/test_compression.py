@@ -0,0 +1,98 @@
+import gzip
+from unittest import mock
+
+import aiohttp_mako
+
+
+TEMPLATES = {'tplt.html': '<h1>${head}</h1>${text * 1000}'}
+
+
+async def test_gzip(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+
+    @aiohttp_mako.template('tplt.html', compress=True, etag=True)
+    async def func(request):
+        return {'head': 'HEAD', 'text': 'text'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app, auto_decompress=False)
+
+    resp = await client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 200 == resp.status
+    assert 'gzip' == resp.headers['Content-Encoding']
+    assert 'Accept-Encoding' == resp.headers['Vary']
+    assert resp.headers['ETag'].startswith('W/"')
+    body = gzip.decompress(await resp.read())
+    assert '<h1>HEAD</h1>' + 'text' * 1000 == body.decode('utf-8')
+
+    etag = resp.headers['ETag']
+    resp = await client.get('/', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert 304 == resp.status
+    assert etag == resp.headers['ETag']
+
+    resp = await client.get('/', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 200 == resp.status
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Accept-Encoding' == resp.headers['Vary']
+
+
+async def test_etag_callable_not_compressed(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('short.html', '<h1>${head}</h1>')
+
+    @aiohttp_mako.template('short.html', compress=True,
+                           etag=lambda request, context: 'v1')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app, auto_decompress=False)
+
+    resp = await client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 200 == resp.status
+    assert 'Content-Encoding' not in resp.headers
+    assert 'W/"v1"' == resp.headers['ETag']
+    resp = await client.get('/', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': 'W/"v1"'})
+    assert 304 == resp.status
+    assert 'W/"v1"' == resp.headers['ETag']
+    resp = await client.get('/', headers={'Accept-Encoding': 'identity',
+                                          'If-None-Match': '"v1"'})
+    assert 304 == resp.status
+    assert '"v1"' == resp.headers['ETag']
+
+
+async def test_min_size(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+
+    @aiohttp_mako.template('tplt.html', compress=10000)
+    async def func(request):
+        return {'head': 'HEAD', 'text': 'text'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app, auto_decompress=False)
+
+    resp = await client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 200 == resp.status
+    assert 'Content-Encoding' not in resp.headers
+
+
+async def test_cached_compressed(make_app, aiohttp_client):
+    app = make_app(TEMPLATES, render_cache=aiohttp_mako.RenderCache())
+
+    @aiohttp_mako.template('tplt.html', compress=True, cache_key='key')
+    async def func(request):
+        return {'head': 'HEAD', 'text': 'text'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    with mock.patch.dict(aiohttp_mako._COMPRESSORS,
+                         {'gzip': mock.Mock(wraps=gzip.compress)}) as comp:
+        for i in range(3):
+            resp = await client.get('/', headers={'Accept-Encoding': 'gzip'})
+            assert 200 == resp.status
+            assert '<h1>HEAD</h1>' + 'text' * 1000 == await resp.text()
+        assert 1 == comp['gzip'].call_count
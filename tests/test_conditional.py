@@ -0,0 +1,89 @@
+import datetime
+
+import aiohttp_mako
+
+
+TEMPLATES = {'tplt.html': '<h1>${head}</h1>${counter()}'}
+
+
+def make_counter():
+    calls = []
+
+    def counter():
+        calls.append(1)
+        return ''
+    counter.calls = calls
+    return counter
+
+
+async def test_etag(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+    counter = make_counter()
+
+    @aiohttp_mako.template('tplt.html', etag=True)
+    async def func(request):
+        return {'head': 'HEAD', 'counter': counter}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/')
+    assert 200 == resp.status
+    etag = resp.headers['ETag']
+    assert '<h1>HEAD</h1>' == await resp.text()
+
+    resp = await client.get('/', headers={'If-None-Match': etag})
+    assert 304 == resp.status
+    assert etag == resp.headers['ETag']
+    assert b'' == await resp.read()
+
+    resp = await client.get('/', headers={'If-None-Match': '"other"'})
+    assert 200 == resp.status
+    assert 3 == len(counter.calls)
+
+
+async def test_etag_version_skips_render(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+    counter = make_counter()
+
+    @aiohttp_mako.template('tplt.html', status=201,
+                           etag=lambda request, context: context['version'])
+    async def func(request):
+        return {'head': 'HEAD', 'counter': counter, 'version': 'v1'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/')
+    assert 201 == resp.status
+    assert '"v1"' == resp.headers['ETag']
+
+    resp = await client.get('/', headers={'If-None-Match': 'W/"v1", "v0"'})
+    assert 304 == resp.status
+    assert 1 == len(counter.calls)
+
+
+async def test_last_modified(make_app, aiohttp_client):
+    app = make_app(TEMPLATES)
+    counter = make_counter()
+    modified = datetime.datetime(2020, 1, 1, 12, 0, 0, 500)
+
+    async def func(request):
+        return await aiohttp_mako.render_template_async(
+            'tplt.html', request, {'head': 'HEAD', 'counter': counter},
+            last_modified=modified)
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/')
+    assert 200 == resp.status
+    last_modified = resp.headers['Last-Modified']
+    assert 'Wed, 01 Jan 2020 12:00:01 GMT' == last_modified
+
+    resp = await client.get('/', headers={'If-Modified-Since': last_modified})
+    assert 304 == resp.status
+    resp = await client.get(
+        '/', headers={'If-Modified-Since': 'Wed, 01 Jan 2020 11:00:00 GMT'})
+    assert 200 == resp.status
+    assert 2 == len(counter.calls)
@@ -1,3 +1,8 @@
+import asyncio
+import os
+
+import pytest
+
 from aiohttp import web
 
 import aiohttp_mako
@@ -103,3 +108,246 @@ async def test_request_processor(aiohttp_client):
     assert 200 == resp.status
     txt = await resp.text()
     assert '<html><body><h1>HEAD</h1>path=/</body></html>' == txt
+
+
+async def test_concurrent(aiohttp_client):
+    started = []
+    release = asyncio.Event()
+
+    async def context_processor1(request):
+        started.append(1)
+        await release.wait()
+        return {'head': 'HEAD', 'text': 'foo'}
+
+    async def context_processor2(request):
+        started.append(2)
+        if len(started) == 2:
+            release.set()
+        return {'text': 'bar'}
+
+    app = create_app([context_processor1, context_processor2])
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>bar</body></html>' == txt
+
+
+async def test_timeout(aiohttp_client):
+
+    async def context_processor1(request):
+        return {'head': 'HEAD', 'text': 'foo'}
+
+    async def context_processor2(request):
+        await asyncio.sleep(10)
+        return {'text': 'bar'}
+
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, input_encoding='utf-8',
+                                output_encoding='utf-8',
+                                default_filters=['decode.utf8'],
+                                context_processors=[context_processor1,
+                                                    context_processor2],
+                                context_processors_timeout=0.01)
+    tplt = "<html><body><h1>${head}</h1>${text}</body></html>"
+    lookup.put_string('tplt.html', tplt)
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>foo</body></html>' == txt
+
+
+async def test_lazy(aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('user')
+    async def user_processor(request):
+        calls.append('user')
+        return {'user': 'USER'}
+
+    @aiohttp_mako.provides('flags')
+    async def flags_processor(request):
+        calls.append('flags')
+        return {'flags': 'FLAGS'}
+
+    app = create_app([user_processor, flags_processor])
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('base.html', '<html>${user} ${self.body()}</html>')
+    lookup.put_string('page.html', '<%inherit file="base.html"/>${head}')
+
+    @aiohttp_mako.template('page.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert '<html>USER HEAD</html>' == txt
+    assert ['user'] == calls
+
+
+async def test_lazy_dynamic_context(aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('user')
+    async def user_processor(request):
+        calls.append('user')
+        return {'user': 'USER'}
+
+    app = create_app([user_processor])
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('page.html', "${context.get('user')}")
+
+    @aiohttp_mako.template('page.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 'USER' == await resp.text()
+    assert ['user'] == calls
+
+
+@pytest.mark.parametrize('source', [
+    '${nav(context)}',
+    '<%namespace name="s" module="string"/>${x}',
+])
+async def test_lazy_context_passed(source, aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('user')
+    async def user_processor(request):
+        calls.append('user')
+        return {'user': 'USER'}
+
+    app = create_app([user_processor])
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('helper.html', source)
+    lookup.put_string('page.html', '<%include file="helper.html"/>')
+
+    @aiohttp_mako.template('page.html')
+    async def func(request):
+        return {'nav': lambda context: context['user'], 'x': 'X'}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert ['user'] == calls
+
+
+async def test_lazy_page_args(aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('user')
+    async def user_processor(request):
+        calls.append('user')
+        return {'user': 'USER'}
+
+    @aiohttp_mako.provides('title')
+    async def title_processor(request):
+        calls.append('title')
+        return {'title': 'TITLE'}
+
+    app = create_app([user_processor, title_processor])
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('base.html', '<%page args="title, **kw"/>${title} '
+                                   '${next.body(**kw)}')
+    lookup.put_string('page.html', '<%inherit file="base.html"/>'
+                                   '<%page args="user"/>${user}')
+
+    @aiohttp_mako.template('page.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert 'TITLE USER' == await resp.text()
+    assert ['title', 'user'] == sorted(calls)
+
+
+async def test_lazy_dependency_changed(tmp_path, aiohttp_client):
+    calls = []
+
+    @aiohttp_mako.provides('user')
+    async def user_processor(request):
+        calls.append('user')
+        return {'user': 'USER'}
+
+    base = tmp_path / 'base.html'
+    base.write_text('<html>${self.body()}</html>')
+    (tmp_path / 'page.html').write_text('<%inherit file="base.html"/>${x}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)],
+                       context_processors=[user_processor])
+
+    @aiohttp_mako.template('page.html')
+    async def func(request):
+        return {'x': 'X'}
+
+    app.router.add_route('GET', '/', func)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert '<html>X</html>' == await resp.text()
+    assert [] == calls
+
+    base.write_text('<html>${user} ${self.body()}</html>')
+    modified = os.stat(str(base)).st_mtime + 10
+    os.utime(str(base), (modified, modified))
+    resp = await client.get('/')
+    assert '<html>USER X</html>' == await resp.text()
+    assert ['user'] == calls
+
+
+async def test_lazy_not_run(aiohttp_client):
+
+    @aiohttp_mako.provides('head')
+    async def context_processor(request):
+        return {'head': 'HEAD'}
+
+    app = create_app([context_processor])
+
+    async def func(request):
+        return aiohttp_mako.render_template('tplt.html', request,
+                                            {'text': 'text'})
+
+    async def func_run(request):
+        await aiohttp_mako.run_context_processors(request, 'tplt.html')
+        return aiohttp_mako.render_template('tplt.html', request,
+                                            {'text': 'text'})
+
+    app.router.add_route('GET', '/', func)
+    app.router.add_route('GET', '/run', func_run)
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 500 == resp.status
+    resp = await client.get('/run')
+    assert 200 == resp.status
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>text</body></html>' == txt
@@ -0,0 +1,119 @@
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from mako.exceptions import TemplateLookupException
+
+import aiohttp_mako
+
+PAGE = """<%inherit file="base.html"/>
+<%block name="content"><ul>
+% for item in items:
+${row(item)}
+% endfor
+</ul></%block>
+<%def name="row(item)"><li>${prefix}${item}</li></%def>"""
+
+
+@pytest.fixture
+def lookup(app):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('base.html',
+                      '<html><h1>${title}</h1>${self.content()}</html>')
+    lookup.put_string('page.html', PAGE)
+    return lookup
+
+
+async def test_template_fragment(app, lookup, aiohttp_client):
+
+    @aiohttp_mako.template('page.html', fragment='content')
+    async def func(request):
+        return {'title': 'TITLE', 'items': [1, 2], 'prefix': '#'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert 'text/html; charset=utf-8' == resp.headers['Content-Type']
+    txt = await resp.text()
+    assert '<ul>\n<li>#1</li>\n<li>#2</li>\n</ul>' == txt
+
+
+async def test_render_fragment_def(app, lookup, aiohttp_client):
+
+    async def func(request):
+        return aiohttp_mako.render_fragment(
+            'page.html', 'row', request, {'item': 3, 'prefix': '#'},
+            status=201)
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 201 == resp.status
+    assert '<li>#3</li>' == await resp.text()
+
+
+async def test_fragment_context_processors(aiohttp_client):
+
+    async def processor(request):
+        return {'prefix': '*'}
+
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, context_processors=[processor])
+    lookup.put_string('base.html', '${self.content()}')
+    lookup.put_string('page.html', PAGE)
+
+    @aiohttp_mako.template('page.html', fragment='row')
+    async def func(request):
+        return {'item': 4}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert '<li>*4</li>' == await resp.text()
+
+
+def test_fragment_cached(app, lookup):
+    req = make_mocked_request('GET', '/', app=app)
+    template = lookup.get_template('page.html')
+    aiohttp_mako.render_fragment('page.html', 'row', req,
+                                 {'item': 1, 'prefix': ''})
+    fragment = template._aiohttp_mako_fragments['row']
+    aiohttp_mako.render_fragment('page.html', 'row', req,
+                                 {'item': 2, 'prefix': ''})
+    assert template._aiohttp_mako_fragments['row'] is fragment
+
+
+def test_fragment_missing(app, lookup):
+    req = make_mocked_request('GET', '/', app=app)
+
+    with pytest.raises(web.HTTPInternalServerError) as ctx:
+        aiohttp_mako.render_fragment('page.html', 'missing', req, {})
+
+    assert "Fragment 'missing' not found in template 'page.html'" == \
+        ctx.value.text
+
+
+def test_fragment_error(app, lookup):
+    lookup.put_string('broken.html', '<%def name="broken()">${1 / 0}</%def>')
+    req = make_mocked_request('GET', '/', app=app)
+
+    with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+        aiohttp_mako.render_fragment('broken.html', 'broken', req, {})
+
+    assert 'ZeroDivisionError' in str(ctx.value)
+
+
+async def test_fragment_missing_on_startup(app, lookup):
+
+    @aiohttp_mako.template('page.html', fragment='missing')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+    app.freeze()
+
+    with pytest.raises(TemplateLookupException) as ctx:
+        await app.startup()
+
+    assert "Fragment 'missing' of handler" in str(ctx.value)
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+from aiohttp import web
+
+import aiohttp_mako
+
+
+def test_policy_average():
+    policy = aiohttp_mako.OffloadPolicy(0.01, smoothing=0.5)
+    assert not policy.should_offload('tplt.html')
+
+    policy.observe('tplt.html', 0.004)
+    assert 0.004 == policy.averages['tplt.html']
+    policy.observe('tplt.html', 0.02)
+    assert abs(policy.averages['tplt.html'] - 0.012) < 1e-9
+    assert policy.should_offload('tplt.html')
+    assert not policy.should_offload('other.html')
+
+    policy.observe('tplt.html', 0.002)
+    assert not policy.should_offload('tplt.html')
+
+
+def test_policy_warning(caplog):
+    policy = aiohttp_mako.OffloadPolicy(0.01)
+    with caplog.at_level(logging.WARNING, logger='aiohttp_mako'):
+        policy.observe('tplt.html', 0.02)
+        policy.observe('tplt.html', 0.03, inline=True)
+
+    record, = caplog.records
+    assert "Template 'tplt.html' blocked event loop" in record.getMessage()
+
+
+async def test_adaptive_offload(aiohttp_client, caplog):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, offload_budget=0.01)
+    lookup.put_string('tplt.html', '${work()}')
+    delays = [0.02]
+
+    def work():
+        time.sleep(delays[0])
+        return threading.current_thread().name
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {'work': work}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    main_thread = threading.current_thread().name
+
+    resp = await client.get('/')
+    assert main_thread == await resp.text()
+    assert "Template 'tplt.html' blocked event loop" in caplog.text
+
+    resp = await client.get('/')
+    assert main_thread != await resp.text()
+
+    delays[0] = 0
+    for i in range(20):
+        resp = await client.get('/')
+        if main_thread == await resp.text():
+            break
+    else:
+        assert False, 'fast template is still offloaded'
+
+
+async def test_offload_process_pool(aiohttp_client):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(
+        app, offload_budget=0.01, processes=1,
+        context_processors=[aiohttp_mako.request_processor])
+    lookup.put_string('tplt.html', '${work()} ${request.path}')
+
+    def work():
+        time.sleep(0.02)
+        return threading.current_thread().name
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {'work': work}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    main_thread = threading.current_thread().name
+
+    resp = await client.get('/')
+    assert main_thread + ' /' == await resp.text()
+
+    resp = await client.get('/')
+    assert 200 == resp.status
+    thread, path = (await resp.text()).split()
+    assert main_thread != thread
+    assert '/' == path
@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+TEMPLATES = {'tplt.html': '<h1>${head}</h1>${counter()}'}
+
+
+def make_counter():
+    calls = []
+
+    def counter():
+        calls.append(1)
+        return len(calls)
+    return counter
+
+
+async def test_template_cache(make_app, aiohttp_client):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    counter = make_counter()
+
+    @aiohttp_mako.template('tplt.html', cache_key=True)
+    async def func(request):
+        return {'head': request.query['head'], 'counter': counter}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    for i in range(3):
+        resp = await client.get('/', params={'head': 'HEAD'})
+        assert 200 == resp.status
+        assert '<h1>HEAD</h1>1' == await resp.text()
+    resp = await client.get('/', params={'head': 'OTHER'})
+    assert '<h1>OTHER</h1>2' == await resp.text()
+
+    assert 2 == cache.hits
+    assert 2 == cache.misses
+
+
+async def test_template_cache_key_ignores_processors(make_app, aiohttp_client):
+    cache = aiohttp_mako.RenderCache()
+
+    async def processor(request):
+        return {'session': object()}
+
+    app = make_app(TEMPLATES, render_cache=cache,
+                   context_processors=[processor])
+    counter = make_counter()
+
+    @aiohttp_mako.template('tplt.html', cache_key=True)
+    async def func(request):
+        return {'head': 'HEAD', 'counter': counter}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    for i in range(2):
+        resp = await client.get('/')
+        assert '<h1>HEAD</h1>1' == await resp.text()
+    assert 1 == cache.hits
+
+
+async def test_template_cache_key_default_repr(make_app, aiohttp_client):
+    app = make_app(TEMPLATES, render_cache=aiohttp_mako.RenderCache())
+
+    @aiohttp_mako.template('tplt.html', cache_key=True)
+    async def func(request):
+        return {'head': 'HEAD', 'counter': make_counter(),
+                'items': [object()]}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/')
+    assert 500 == resp.status
+    assert "Context value 'items' of <class 'object'>" in await resp.text()
+
+
+async def test_template_cache_key_callable(make_app, aiohttp_client):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    counter = make_counter()
+
+    @aiohttp_mako.template('tplt.html',
+                           cache_key=lambda request, context: 'key')
+    async def func(request):
+        return {'head': request.query['head'], 'counter': counter}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/', params={'head': 'HEAD'})
+    assert '<h1>HEAD</h1>1' == await resp.text()
+    resp = await client.get('/', params={'head': 'OTHER'})
+    assert '<h1>HEAD</h1>1' == await resp.text()
+
+
+def test_render_string_cache_invalidate(make_app):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    req = make_mocked_request('GET', '/', app=app)
+    context = {'head': 'HEAD', 'counter': make_counter()}
+
+    def render():
+        return aiohttp_mako.render_string('tplt.html', req, context,
+                                          app_key=aiohttp_mako.APP_KEY,
+                                          cache_key='key')
+
+    assert '<h1>HEAD</h1>1' == render()
+    assert '<h1>HEAD</h1>1' == render()
+    cache.invalidate('other.html')
+    assert '<h1>HEAD</h1>1' == render()
+    cache.invalidate('tplt.html')
+    assert '<h1>HEAD</h1>2' == render()
+
+
+def test_cache_lru_and_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(aiohttp_mako.time, 'monotonic', lambda: now[0])
+    cache = aiohttp_mako.RenderCache(maxsize=2, ttl=10)
+
+    cache.set('a.html', 1, b'a')
+    cache.set('b.html', 1, b'b')
+    assert b'a' == cache.get('a.html', 1)
+    cache.set('c.html', 1, b'c')
+    assert cache.get('b.html', 1) is None
+    assert b'a' == cache.get('a.html', 1)
+
+    now[0] += 11
+    assert cache.get('a.html', 1) is None
+    assert 1 == len(cache)
+
+
+async def test_render_coalesced(make_app):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    counter = make_counter()
+
+    def slow_counter():
+        time.sleep(0.05)
+        return counter()
+
+    async def render():
+        req = make_mocked_request('GET', '/', app=app)
+        resp = await aiohttp_mako.render_template_async(
+            'tplt.html', req, {'head': 'HEAD', 'counter': slow_counter},
+            cache_key='key')
+        return resp.body
+
+    bodies = await asyncio.gather(*[render() for i in range(5)])
+    assert [b'<h1>HEAD</h1>1'] * 5 == bodies
+    assert 4 == cache.coalesced
+    assert 1 == len(cache)
+
+
+async def test_render_coalesced_error(make_app):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    req = make_mocked_request('GET', '/', app=app)
+
+    def broken():
+        time.sleep(0.01)
+        raise ValueError('broken')
+
+    results = await asyncio.gather(*[
+        aiohttp_mako.render_string_async(
+            'tplt.html', req, {'head': 'HEAD', 'counter': broken},
+            cache_key='key')
+        for i in range(3)], return_exceptions=True)
+    for result in results:
+        assert isinstance(result, aiohttp_mako.MakoRenderingException)
+    assert 2 == cache.coalesced
+    assert 0 == len(cache)
+    assert not cache._pending
+
+
+async def test_stale_while_revalidate(make_app, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(aiohttp_mako.time, 'monotonic', lambda: now[0])
+    cache = aiohttp_mako.RenderCache(ttl=10, stale_ttl=60)
+    app = make_app(TEMPLATES, render_cache=cache)
+    req = make_mocked_request('GET', '/', app=app)
+    context = {'head': 'HEAD', 'counter': make_counter()}
+
+    def render():
+        return aiohttp_mako.render_template('tplt.html', req, context,
+                                            cache_key='key').body
+
+    assert b'<h1>HEAD</h1>1' == render()
+    now[0] += 11
+    assert b'<h1>HEAD</h1>1' == render()
+    assert b'<h1>HEAD</h1>1' == render()
+    assert 2 == cache.stale_hits
+    await asyncio.gather(*cache._pending.values())
+    assert b'<h1>HEAD</h1>2' == render()
+
+    now[0] += 100
+    assert b'<h1>HEAD</h1>3' == render()
+
+
+async def test_stale_refresh_failed(make_app, monkeypatch, caplog):
+    now = [100.0]
+    monkeypatch.setattr(aiohttp_mako.time, 'monotonic', lambda: now[0])
+    cache = aiohttp_mako.RenderCache(ttl=10, stale_ttl=60)
+    app = make_app(TEMPLATES, render_cache=cache)
+    req = make_mocked_request('GET', '/', app=app)
+    counters = [make_counter()]
+
+    async def render():
+        return await aiohttp_mako.render_string_async(
+            'tplt.html', req, {'head': 'HEAD', 'counter': counters[0]},
+            cache_key='key')
+
+    assert '<h1>HEAD</h1>1' == await render()
+    now[0] += 11
+    counters[0] = None
+    assert '<h1>HEAD</h1>1' == await render()
+    await asyncio.gather(*cache._pending.values(), return_exceptions=True)
+    assert 'Failed to refresh cached render' in caplog.text
+    assert '<h1>HEAD</h1>1' == await render()
+    await asyncio.gather(*cache._pending.values(), return_exceptions=True)
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import aiohttp_mako
+
+
+async def collect(batch):
+    results = []
+    async for result in batch:
+        results.append(result)
+    return results
+
+
+async def test_render_many(app):
+    contexts = [{'head': i, 'text': ''} for i in range(20)]
+
+    results = await collect(aiohttp_mako.render_many(app, 'tplt.html',
+                                                     contexts))
+
+    assert list(range(20)) == [result.index for result in results]
+    assert '<html><body><h1>7</h1></body></html>' == results[7].output
+    assert all(result.exception is None for result in results)
+
+
+async def test_render_many_failed(app):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('div.html', '${1 // x}')
+    contexts = [{'x': 1}, {'x': 0}, {'x': 2}]
+
+    results = await collect(aiohttp_mako.render_many(
+        lookup, 'div.html', contexts, encoding='utf-8', ordered=False))
+
+    results.sort()
+    assert [b'1', None, b'0'] == [result.output for result in results]
+    assert isinstance(results[1].exception,
+                      aiohttp_mako.MakoRenderingException)
+    assert 'ZeroDivisionError' in str(results[1].exception)
+
+
+async def test_render_many_bounded(app):
+    executor = ThreadPoolExecutor(max_workers=2)
+    taken = []
+    in_flight = []
+
+    def contexts():
+        for i in range(10):
+            taken.append(i)
+            yield {'head': i, 'text': ''}
+
+    batch = aiohttp_mako.render_many(app, 'tplt.html', contexts(),
+                                     executor=executor, max_in_flight=3)
+    async for result in batch:
+        in_flight.append(len(taken) - result.index)
+    executor.shutdown()
+
+    assert 10 == len(taken)
+    assert 3 == max(in_flight)
+
+
+async def test_render_many_process_pool(tmp_path):
+    (tmp_path / 'item.html').write_text('${item}')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)], processes=1)
+
+    results = await collect(aiohttp_mako.render_many(
+        app, 'item.html', ({'item': i} for i in range(5))))
+    app[aiohttp_mako.APP_EXECUTOR_KEY].shutdown()
+
+    assert ['0', '1', '2', '3', '4'] == [result.output for result in results]
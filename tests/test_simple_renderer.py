@@ -1,7 +1,10 @@
+from types import MappingProxyType
+
 import pytest
 
 from aiohttp import web
 from aiohttp.test_utils import make_mocked_request
+from mako.exceptions import TemplateLookupException
 from mako.lookup import TemplateLookup
 
 import aiohttp_mako
@@ -124,3 +127,97 @@ async def test_get_env():
     lookup2 = aiohttp_mako.get_lookup(app)
     assert lookup1 is lookup2
     assert isinstance(lookup2, TemplateLookup)
+
+
+async def test_render_string_mapping(app):
+    context = MappingProxyType({'head': 'HEAD', 'text': 'text'})
+    req = make_mocked_request('GET', '/', app=app)
+    req[aiohttp_mako.REQUEST_CONTEXT_KEY] = processors_context = {
+        'head': 'PROCESSOR', 'extra': 'extra'}
+
+    txt = aiohttp_mako.render_string('tplt.html', req, context,
+                                     app_key=aiohttp_mako.APP_KEY)
+
+    assert '<html><body><h1>HEAD</h1>text</body></html>' == txt
+    assert {'head': 'PROCESSOR', 'extra': 'extra'} == processors_context
+
+
+async def test_render_inherited_page_args(app):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('base.html', '<%page args="title"/>'
+                                   '<title>${title}</title>${next.body()}')
+    lookup.put_string('child.html', '<%inherit file="base.html"/>${text}')
+    req = make_mocked_request('GET', '/', app=app)
+
+    txt = aiohttp_mako.render_string('child.html', req,
+                                     {'title': 'TITLE', 'text': 'text'},
+                                     app_key=aiohttp_mako.APP_KEY)
+
+    assert '<title>TITLE</title>text' == txt
+
+
+async def test_render_page_kwargs(app):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('kw.html', '<%page args="**kw"/>${sorted(kw)}')
+    req = make_mocked_request('GET', '/', app=app)
+    req[aiohttp_mako.REQUEST_CONTEXT_KEY] = {'y': 'processor'}
+
+    txt = aiohttp_mako.render_string('kw.html', req, {'x': 'x'},
+                                     app_key=aiohttp_mako.APP_KEY)
+
+    assert "['x', 'y']" == txt
+
+
+async def test_template_bound_on_startup(app, aiohttp_client):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.filesystem_checks = False
+
+    @aiohttp_mako.template('tplt.html', status=201)
+    async def func(request):
+        return {'head': 'HEAD', 'text': 'text'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+
+    template = app[aiohttp_mako.APP_BOUND_TEMPLATES_KEY][
+        aiohttp_mako.APP_KEY, 'tplt.html']
+    assert lookup.get_template('tplt.html') is template
+    lookup._collection.clear()
+
+    resp = await client.get('/')
+    assert 201 == resp.status
+    assert 'text/html; charset=utf-8' == resp.headers['Content-Type']
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>text</body></html>' == txt
+
+
+async def test_template_missing_on_startup(app):
+
+    @aiohttp_mako.template('missing.html')
+    async def func(request):
+        return {}
+
+    app.router.add_route('GET', '/', func)
+    app.freeze()
+
+    with pytest.raises(TemplateLookupException) as ctx:
+        await app.startup()
+
+    assert "Template 'missing.html' of handler" in str(ctx.value)
+
+
+async def test_render_large_encoded(app, aiohttp_client):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('rows.html', '% for i in rows:\n${i}☃\n% endfor\n')
+
+    @aiohttp_mako.template('rows.html', encoding='utf-16')
+    async def func(request):
+        return {'rows': range(10000)}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert 'text/html; charset=utf-16' == resp.headers['Content-Type']
+    expected = ''.join('{}☃\n'.format(i) for i in range(10000))
+    assert expected.encode('utf-16') == await resp.read()
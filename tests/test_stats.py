@@ -0,0 +1,95 @@
+from aiohttp import web
+
+import aiohttp_mako
+
+
+class Observer:
+
+    def __init__(self):
+        self.started = []
+        self.done = []
+
+    def on_render_start(self, request, event):
+        self.started.append(event.template_name)
+
+    def on_render_done(self, request, event):
+        self.done.append(event)
+
+
+async def test_observer(aiohttp_client):
+    observer = Observer()
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, observers=[observer])
+    lookup.put_string('tplt.html', '<h1>${head}</h1>')
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+
+    assert ['tplt.html'] == observer.started
+    event, = observer.done
+    assert 'tplt.html' == event.template_name
+    assert event.lookup_time >= 0
+    assert event.compile_time is None
+    assert event.render_time >= 0
+    assert len(b'<h1>HEAD</h1>') == event.size
+    assert event.exception is None
+
+
+async def test_observer_error(aiohttp_client):
+    observer = Observer()
+    app = web.Application()
+    aiohttp_mako.setup(app, observers=[observer],
+                       directories=[], filesystem_checks=False)
+    app[aiohttp_mako.APP_ON_RENDER_START_KEY].append(
+        lambda request, event: observer.started.append('signal'))
+
+    async def func(request):
+        return aiohttp_mako.render_template('missing.html', request, {})
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 500 == resp.status
+
+    assert ['missing.html', 'signal'] == observer.started
+    event, = observer.done
+    assert isinstance(event.exception, web.HTTPInternalServerError)
+
+
+async def test_stats_handler(tmp_path, aiohttp_client):
+    (tmp_path / 'tplt.html').write_text('<h1>${head}</h1>')
+    app = web.Application()
+    aiohttp_mako.setup(app, directories=[str(tmp_path)], stats=True)
+
+    @aiohttp_mako.template('tplt.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    app.router.add_route('GET', '/metrics', aiohttp_mako.render_stats_handler)
+    client = await aiohttp_client(app)
+    for i in range(2):
+        resp = await client.get('/')
+        assert 200 == resp.status
+
+    resp = await client.get('/metrics')
+    assert 200 == resp.status
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    txt = await resp.text()
+    lines = txt.splitlines()
+    assert 'aiohttp_mako_renders_total{template="tplt.html"} 2' in lines
+    assert 'aiohttp_mako_errors_total{template="tplt.html"} 0' in lines
+    # compiled on startup, reported by the first render
+    assert ('aiohttp_mako_compile_seconds_count'
+            '{template="tplt.html"} 1') in lines
+    assert 'aiohttp_mako_render_seconds_count{template="tplt.html"} 2' in lines
+    assert ('aiohttp_mako_output_size_bucket'
+            '{template="tplt.html",le="256"} 2') in lines
+    assert ('aiohttp_mako_output_size_bucket'
+            '{template="tplt.html",le="+Inf"} 2') in lines
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+async def test_render_stream(app, aiohttp_client):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('rows.html',
+                      '% for row in rows:\n<p>${row}</p>\n% endfor\n')
+
+    async def func(request):
+        return await aiohttp_mako.render_stream(
+            'rows.html', request, {'rows': range(1000)}, chunk_size=100)
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert 'text/html; charset=utf-8' == resp.headers['Content-Type']
+    txt = await resp.text()
+    assert txt == ''.join('<p>{}</p>\n'.format(i) for i in range(1000))
+
+
+async def test_render_stream_utf16(app, aiohttp_client):
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('rows.html',
+                      '% for row in rows:\n<p>${row}☃</p>\n% endfor\n')
+
+    async def func(request):
+        return await aiohttp_mako.render_stream(
+            'rows.html', request, {'rows': range(1000)}, encoding='utf-16',
+            chunk_size=100)
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 'text/html; charset=utf-16' == resp.headers['Content-Type']
+    expected = ''.join('<p>{}☃</p>\n'.format(i) for i in range(1000))
+    assert expected.encode('utf-16') == await resp.read()
+
+
+async def test_template_stream(app, aiohttp_client):
+
+    @aiohttp_mako.template('tplt.html', stream=True, status=201)
+    async def func(request):
+        return {'head': 'HEAD', 'text': 'text'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 201 == resp.status
+    txt = await resp.text()
+    assert '<html><body><h1>HEAD</h1>text</body></html>' == txt
+
+
+async def test_stream_threads(make_app, aiohttp_client):
+    app = make_app({'thread.html': '${thread()}'}, stream_threads=1)
+    executor = app[aiohttp_mako.APP_STREAM_EXECUTOR_KEY]
+
+    def thread():
+        return threading.get_ident()
+
+    @aiohttp_mako.template('thread.html', stream=True)
+    async def func(request):
+        return {'thread': thread}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert 200 == resp.status
+    assert str(executor.submit(thread).result()) == await resp.text()
+
+    await client.close()
+    with pytest.raises(RuntimeError):
+        executor.submit(thread)
+
+
+async def test_render_stream_error():
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app)
+    lookup.put_string('broken.html', '${1 / 0}')
+    req = make_mocked_request('GET', '/', app=app)
+
+    with pytest.raises(aiohttp_mako.MakoRenderingException) as ctx:
+        await aiohttp_mako.render_stream('broken.html', req, {})
+
+    assert 'ZeroDivisionError' in str(ctx.value)
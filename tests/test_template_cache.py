@@ -0,0 +1,130 @@
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+TEMPLATES = {
+    name: '<p>${head} ' + name + '</p>'
+    for name in ('a.html', 'b.html', 'c.html', 'layout/base.html')}
+
+
+def test_size_accounting(make_app):
+    cache = aiohttp_mako.TemplateCache(10 ** 9)
+    app = make_app(TEMPLATES, template_cache=cache)
+    lookup = aiohttp_mako.get_lookup(app)
+
+    assert lookup._collection is cache
+    assert 4 == len(cache)
+    assert cache.size('a.html') > 0
+    assert sum(cache.size(uri) for uri in cache) == cache.bytes
+
+    lookup.put_string('a.html', '<p>${head}</p>' * 100)
+    assert 4 == len(cache)
+    assert sum(cache.size(uri) for uri in cache) == cache.bytes
+    assert cache.pop('a.html') is not None
+    assert 'a.html' not in cache
+    assert sum(cache.size(uri) for uri in cache) == cache.bytes
+    cache.clear()
+    assert 0 == cache.bytes
+
+
+def test_evict_least_recently_used(make_app):
+    cache = aiohttp_mako.TemplateCache(10 ** 9)
+    app = make_app(TEMPLATES, template_cache=cache)
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.get_template('a.html')
+    cache.maxbytes = cache.bytes - 1
+
+    lookup.put_string('d.html', '<p>d</p>')
+
+    assert 'b.html' not in cache
+    assert 'a.html' in cache
+    assert 'd.html' in cache
+    assert cache.bytes <= cache.maxbytes
+    assert 1 <= cache.evictions
+
+
+def test_pinned(make_app):
+    cache = aiohttp_mako.TemplateCache(10 ** 9, pinned=['layout/*'])
+    app = make_app(TEMPLATES, template_cache=cache)
+    lookup = aiohttp_mako.get_lookup(app)
+    cache.pin('c.html')
+    cache.maxbytes = 0
+
+    lookup.put_string('d.html', '<p>d</p>')
+
+    assert {'c.html', 'layout/base.html', 'd.html'} == set(cache)
+    assert cache.is_pinned('/layout/base.html')
+    cache.unpin('c.html')
+    assert not cache.is_pinned('c.html')
+
+
+def test_stats(tmp_path):
+    (tmp_path / 'a.html').write_text('<p>${head}</p>')
+    (tmp_path / 'b.html').write_text('<p>b</p>')
+    cache = aiohttp_mako.TemplateCache(10 ** 9)
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, template_cache=cache,
+                                directories=[str(tmp_path)])
+
+    lookup.get_template('a.html')
+    lookup.get_template('a.html')
+    assert 1 == cache.misses
+    assert 1 == cache.hits
+    assert 0 < cache.compile_time
+    assert 0 == cache.recompiles
+
+    cache.maxbytes = cache.bytes
+    lookup.get_template('b.html')
+    lookup.get_template('a.html')
+
+    stats = cache.stats()
+    assert 3 == stats['misses']
+    assert 1 == stats['hits']
+    assert 1 <= stats['evictions']
+    assert 1 == stats['recompiles']
+    assert 0 < stats['recompile_time'] <= stats['compile_time']
+    assert len(cache) == stats['entries']
+    assert cache.bytes == stats['bytes']
+
+
+async def test_decorated_handler_not_bound(make_app, aiohttp_client):
+    cache = aiohttp_mako.TemplateCache(10 ** 9)
+    app = make_app(TEMPLATES, template_cache=cache, filesystem_checks=False,
+                   stats=True)
+
+    @aiohttp_mako.template('a.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    app.router.add_route('GET', '/metrics',
+                         aiohttp_mako.render_stats_handler)
+    client = await aiohttp_client(app)
+
+    assert {} == app[aiohttp_mako.APP_BOUND_TEMPLATES_KEY]
+    resp = await client.get('/')
+    assert '<p>HEAD a.html</p>' == await resp.text()
+    assert 2 <= cache.hits
+
+    resp = await client.get('/metrics')
+    text = await resp.text()
+    assert '# TYPE aiohttp_mako_template_cache_bytes gauge' in text
+    assert 'aiohttp_mako_template_cache_entries{{lookup="{}"}} 4'.format(
+        aiohttp_mako.APP_KEY) in text
+
+
+def test_invalidate_template(make_app):
+    cache = aiohttp_mako.TemplateCache(10 ** 9)
+    app = make_app(TEMPLATES, template_cache=cache,
+                   render_cache=aiohttp_mako.RenderCache())
+    req = make_mocked_request('GET', '/', app=app)
+    aiohttp_mako.render_template('a.html', req, {'head': 'HEAD'},
+                                 cache_key='key')
+    size = cache.bytes
+
+    aiohttp_mako.invalidate_template(app, 'a.html')
+
+    assert 'a.html' not in cache
+    assert size > cache.bytes
@@ -0,0 +1,62 @@
+from aiohttp.test_utils import make_mocked_request
+
+import aiohttp_mako
+
+
+TEMPLATES = {
+    'base.html': '<body>${self.body()}</body>',
+    'helpers.html': '<%def name="bold(x)"><b>${x}</b></%def>',
+    'widgets/nav.html': '<nav><%include file="item.html"/></nav>',
+    'widgets/item.html': '<li>item</li>',
+    'page.html': ('<%inherit file="base.html"/>'
+                  '<%namespace name="h" file="helpers.html"/>'
+                  '<%include file="widgets/nav.html"/>'
+                  '${h.bold(head)}'),
+    'child.html': '<%inherit file="page.html"/>',
+    'other.html': '<p>${head}</p>',
+}
+
+
+def test_graph(make_app):
+    app = make_app(TEMPLATES)
+    graph = aiohttp_mako.get_template_graph(app)
+
+    assert {('inherit', 'base.html'), ('namespace', 'helpers.html'),
+            ('include', 'widgets/nav.html')} == graph.dependencies('page.html')
+    assert {('include', 'widgets/item.html')} == graph.dependencies(
+        '/widgets/nav.html')
+    assert set() == graph.dependencies('other.html')
+    assert {'page.html', 'child.html'} == graph.dependents('base.html')
+    assert {'widgets/nav.html', 'page.html',
+            'child.html'} == graph.dependents('widgets/item.html')
+    assert set() == graph.dependents('other.html')
+    assert ('child.html', 'inherit', 'page.html') == graph.edges()[0]
+
+
+def test_graph_dynamic(make_app):
+    app = make_app(TEMPLATES)
+    lookup = aiohttp_mako.get_lookup(app)
+    lookup.put_string('dynamic.html', '<%include file="${name}"/>')
+    graph = aiohttp_mako.get_template_graph(app)
+
+    assert {('include', None)} == graph.dependencies('dynamic.html')
+    assert 'dynamic.html' in graph.dependents('other.html')
+
+
+def test_invalidate_dependents(make_app):
+    cache = aiohttp_mako.RenderCache()
+    app = make_app(TEMPLATES, render_cache=cache)
+    lookup = aiohttp_mako.get_lookup(app)
+    req = make_mocked_request('GET', '/', app=app)
+    for name in ('page.html', 'child.html', 'other.html'):
+        aiohttp_mako.render_template(name, req, {'head': 'HEAD'},
+                                     cache_key='key')
+    assert 3 == len(cache)
+    page = lookup.get_template('page.html')
+
+    aiohttp_mako.invalidate_template(app, 'base.html')
+
+    assert 1 == len(cache)
+    assert b'<p>HEAD</p>' == cache.get('other.html', ('key', 'utf-8', None))
+    assert 'base.html' not in lookup._collection
+    assert lookup.get_template('page.html') is page
@@ -0,0 +1,112 @@
+import asyncio
+import gc
+import os
+import time
+
+import pytest
+
+from aiohttp import web
+
+import aiohttp_mako
+
+
+@pytest.fixture
+def templates(tmp_path):
+    (tmp_path / 'index.html').write_text('<h1>${head}</h1>')
+    (tmp_path / 'emails').mkdir()
+    (tmp_path / 'emails' / 'welcome.txt').write_text('Hello ${name}')
+    (tmp_path / 'style.css').write_text('h1 { color: red }')
+    return tmp_path
+
+
+def test_warmup(templates):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)])
+
+    assert 3 == aiohttp_mako.warmup(lookup)
+    assert {'index.html', 'emails/welcome.txt',
+            'style.css'} == set(lookup._collection)
+
+
+def test_warmup_patterns(templates):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)])
+
+    assert 2 == aiohttp_mako.warmup(lookup, ['*.html', 'emails/*'])
+    assert {'index.html', 'emails/welcome.txt'} == set(lookup._collection)
+
+
+def test_warmup_failed(templates):
+    (templates / 'broken.html').write_text('% for x in y:\n')
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)])
+
+    with pytest.raises(aiohttp_mako.MakoCompilationException) as ctx:
+        aiohttp_mako.warmup(lookup, ['*.html'])
+
+    assert 'broken.html' in str(ctx.value)
+    assert 'index.html' in lookup._collection
+
+
+async def test_precompile_on_startup(templates, aiohttp_client):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)],
+                                precompile=['*.html'])
+
+    await aiohttp_client(app)
+    assert ['index.html'] == list(lookup._collection)
+
+
+async def test_reload(templates, aiohttp_client):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)],
+                                reload_interval=0.01)
+    assert not lookup.filesystem_checks
+
+    @aiohttp_mako.template('index.html')
+    async def func(request):
+        return {'head': 'HEAD'}
+
+    app.router.add_route('GET', '/', func)
+    client = await aiohttp_client(app)
+    resp = await client.get('/')
+    assert '<h1>HEAD</h1>' == await resp.text()
+
+    path = templates / 'index.html'
+    path.write_text('<h2>${head}</h2>')
+    modified = time.time() + 10
+    os.utime(str(path), (modified, modified))
+    for i in range(100):
+        await asyncio.sleep(0.01)
+        if 'index.html' not in lookup._collection:
+            break
+
+    resp = await client.get('/')
+    assert '<h2>HEAD</h2>' == await resp.text()
+
+
+def test_preload(templates):
+    app = web.Application()
+    lookup = aiohttp_mako.setup(app, directories=[str(templates)])
+
+    try:
+        assert 2 == aiohttp_mako.preload(lookup, ['*.html', 'emails/*'])
+        if hasattr(gc, 'get_freeze_count'):
+            assert gc.get_freeze_count() > 0
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    template = lookup.get_template('index.html')
+    assert template in aiohttp_mako._scan_cache
+    assert template in aiohttp_mako._page_args_cache
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/smaps'),
+                    reason='requires /proc/<pid>/smaps')
+def test_memory_usage():
+    usage = aiohttp_mako.memory_usage()
+    assert usage.rss > 0
+    assert usage.shared + usage.private == usage.rss
+    assert usage.pss <= usage.rss
+    assert aiohttp_mako.memory_usage(os.getpid()).rss > 0